@@ -1,7 +1,11 @@
 import numpy as np
 from scipy.stats import zscore
 from collections import deque
+from operator import itemgetter
+import weakref
+from scipy import ndimage as ndi
 import matplotlib.cm as cm
+from gland_graph import GlandGraph
 
 def display_gland_numbers(G, break_mode = False, break_position = 10, print_number_of_glands=True):
     '''Display `G` (Graph) number of nodes demarcated or not and return lists of each class. 
@@ -43,36 +47,65 @@ def display_gland_numbers(G, break_mode = False, break_position = 10, print_numb
     return nodes, nodes_demarcated
 
   
-def get_table_properties(G, properties, return_normalized=True):
+def get_table_properties(G, properties, return_normalized=True, use_cache=False):
     '''Return table `properties` of `nodes1` and `nodes2` unified with randomized `sample_quantity` normalized or not
-    according to `return_normalized`. If `properties` contains 'idx' value it will not be normalized.'''
-    
-    table_properties = []
-    classes = []
-    for node in G.nodes(True):
-        row_properties = []
-        for prop in properties:
-            row_properties.append(node[1][prop])
-        
-        classes.append(node[1]['demarcated']=='True')
-        table_properties.append(row_properties)
+    according to `return_normalized`. If `properties` contains 'idx' value it will not be normalized. `G` can
+    also be a feature store returned by feature_store.read_feature_store() or a gland_graph.GlandGraph, in 
+    which case the columns are read directly from the (memory-mapped) arrays.
+
+    All columns are extracted in a single pass over the nodes and normalized at once. If `use_cache` is True, 
+    the table is kept for each graph and list of properties, and the following calls with the same graph 
+    return a copy of it. Only use it for graphs that are not modified between calls (or call 
+    clear_table_cache() after modifying them), e.g. in loops over realizations of the cross-validation. 
+    Feature stores are not cached.'''
+
+    key = (tuple(properties), bool(return_normalized))
+    cache = None
+    if use_cache and not isinstance(G, dict):
+        cache = _table_cache.setdefault(G, {})
+        if key in cache:
+            table_properties, classes = cache[key]
+            return table_properties.copy(), classes.copy()
+
+    table_properties, classes = _extract_table_properties(G, properties)
+    if return_normalized:
+        # Normalize values
+        table_properties = table_properties.astype(float)
+        normalize = np.array([prop != 'idx' for prop in properties], dtype=bool)
+        if np.any(normalize):
+            table_properties[:,normalize] = zscore(np.asfortranarray(table_properties[:,normalize]), axis=0)
 
-    classes = np.array(classes)
-    
-    if not return_normalized:
-        return np.array(table_properties), classes
-    
+    if cache is not None:
+        cache[key] = (table_properties, classes)
+        return table_properties.copy(), classes.copy()
+
+    return table_properties, classes
+
+# Tables already extracted by get_table_properties() for each graph
+_table_cache = weakref.WeakKeyDictionary()
+
+def clear_table_cache():
+    '''Remove all the tables kept by get_table_properties().'''
+
+    _table_cache.clear()
+
+def _extract_table_properties(G, properties):
+    '''Table of `properties` and classes of all the nodes of `G`, without normalization.'''
+
+    if isinstance(G, GlandGraph):
+        table_properties = np.column_stack([np.asarray(G.column(prop), dtype=float) for prop in properties])
+        classes = G.demarcated.copy()
+    elif isinstance(G, dict):
+        columns = G['columns']
+        table_properties = np.column_stack([np.asarray(columns[prop], dtype=float) for prop in properties])
+        classes = np.asarray(columns['demarcated'], dtype=bool)
     else:
-        # Normalize values
-        table_properties_normalized = np.zeros((len(table_properties), len(properties)))
-        array_table_properties = np.array(table_properties)
-        for col, prop in enumerate(properties):
-            if prop == 'idx':
-                table_properties_normalized[:,col] = array_table_properties[:,col]
-            else:
-                table_properties_normalized[:,col] = zscore(array_table_properties[:,col])
-
-        return table_properties_normalized, classes   
+        node_data = [data for _, data in G.nodes(data=True)]
+        table_properties = np.array(list(map(itemgetter(*properties), node_data)))
+        table_properties = table_properties.reshape(len(node_data), len(properties))
+        classes = np.fromiter((data['demarcated']=='True' for data in node_data), dtype=bool, count=len(node_data))
+
+    return table_properties, classes
     
 def remove_idx_from_table_properties(properties_names, table_properties):
     if properties_names[0] == 'idx':
@@ -87,6 +120,10 @@ def get_color_inputs(G, measurment_prop='degree'):
     color_demarcated     = [228,26,28]   #demarcated        - classified as unhealth
     color_undefined      = [77,175,74]   #undefined         - undefined value
 
+    if isinstance(G, GlandGraph):
+        class_colors = np.where(G.demarcated[:,None], color_demarcated, color_not_demarcated).tolist()
+        return G.centroids.tolist(), class_colors, G.column(measurment_prop).tolist()
+
     #inputs
     position = []
     measurements = []
@@ -112,10 +149,9 @@ def get_color_inputs(G, measurment_prop='degree'):
 
 def color_objects(img_bin, positions, colors=None, values=None, colormap='viridis', print_progress=False):
     '''Color objects in binary image `img_bin`. `positions` must contain one pixel position
-    inside each object.'''
+    inside each object. The image is labeled once (8-connectivity, as in flood_fill()) and each
+    object is painted through a color lookup table indexed by its label.'''
 
-    img_pad = np.pad(img_bin, 1, 'constant') 
-    
     if (colors is None) and (values is None):
         raise ValueError("Either `colors` or `values` must be set")
     if colors is None:   
@@ -132,20 +168,38 @@ def color_objects(img_bin, positions, colors=None, values=None, colormap='viridi
         values = (values-values.min())/(values.max()-values.min())
         colors = cmap(values)[:,:-1]
         colors = np.round(255*colors).astype(int)
-    
-    positions = np.array(positions)
-    positions += 1
-    img_colored = np.zeros((img_bin.shape[0], img_bin.shape[1], 3), dtype=np.uint8)
-    
-    # Color each connected component using `positions` as seed
-    for idx, pos in enumerate(positions):
-        pixels = flood_fill(img_pad, pos, print_progress)
-        pixels -= 1
-        #img_colored[pixels[:,0], pixels[:,1]] = colors[idx]
-        try:
-            img_colored[pixels[:,0][pixels[:,0]<img_colored.shape[0]], pixels[:,1][pixels[:,1]<img_colored.shape[1]]] = colors[idx]
-        except:
-            print('except ERRO')
+
+    colors = np.array(colors).reshape(-1, 3)
+    positions = np.array(positions, dtype=int).reshape(-1, 2)
+    img_label, num_comp = ndi.label(img_bin>0, np.ones((3, 3)))
+    if print_progress:
+        print(f'{num_comp} objects, {len(positions)} seeds')
+
+    # Objects colored by each seed. A seed on the background also colors itself and the objects 
+    # touching it, as the flood fill does
+    seed_labels = img_label[positions[:,0], positions[:,1]]
+    seeds_bg = np.nonzero(seed_labels==0)[0]
+    seed_idx = [np.nonzero(seed_labels>0)[0]]
+    object_labels = [seed_labels[seed_idx[0]]]
+    img_pad = np.pad(img_label, 1, 'constant')
+    for idx in seeds_bg:
+        row, col = positions[idx]
+        neighbor_labels = np.unique(img_pad[row:row+3, col:col+3])
+        neighbor_labels = neighbor_labels[neighbor_labels>0]
+        seed_idx.append(np.full(len(neighbor_labels), idx))
+        object_labels.append(neighbor_labels)
+    seed_idx = np.concatenate(seed_idx)
+    object_labels = np.concatenate(object_labels)
+
+    # When an object has more than one seed, the color of the last seed is used
+    order = np.argsort(seed_idx, kind='stable')[::-1]
+    object_labels, first = np.unique(object_labels[order], return_index=True)
+    lut = np.zeros((num_comp+1, 3), dtype=np.uint8)
+    lut[object_labels] = colors[seed_idx[order][first]]
+
+    img_colored = lut[img_label]
+    for idx in seeds_bg:
+        img_colored[positions[idx,0], positions[idx,1]] = colors[idx]
 
     return img_colored        
 
@@ -157,8 +211,6 @@ def flood_fill(img_bin, initial_pixel, print_progress=False):
     pixels_to_analyze = deque([initial_pixel])
     visited_pixels = set([initial_pixel])
     
-    img_colored = np.zeros((img_bin.shape[0], img_bin.shape[1], 3), dtype=np.uint8)
-    
     while len(pixels_to_analyze)>0: 
         
         current_pixel = pixels_to_analyze.popleft()
@@ -206,6 +258,15 @@ def get_color_inputs_by_cross_results(G, classes_pred, test_index, graph_idx):
     false_negative = 0
     true_positive = 0
     false_positive = 0
+
+    if isinstance(G, GlandGraph):
+        nodes = np.asarray(graph_idx)[np.asarray(test_index, dtype=int)].astype(int)
+        outcomes = _prediction_outcomes(G, nodes, np.asarray(classes_pred)[:len(nodes)])
+        class_colors, (true_negative, false_negative, true_positive, false_positive) = _outcome_colors(
+            outcomes, [blue_color, light_blue_color, red_color, light_red_color])
+        confusion_matrix = [ [true_negative, false_negative],
+                             [false_positive, true_positive] ]
+        return G.centroids[nodes].tolist(), class_colors, G.column('area')[nodes].tolist(), confusion_matrix
     
     list_nodes = G.nodes()
 
@@ -283,6 +344,15 @@ def get_colors_by_pred_results(G, classes_pred):
     true_positive  = 0
     false_positive = 0
 
+    if isinstance(G, GlandGraph):
+        nodes = np.arange(len(classes_pred))
+        outcomes = _prediction_outcomes(G, nodes, np.asarray(classes_pred))
+        class_colors, (true_negative, false_negative, true_positive, false_positive) = _outcome_colors(
+            outcomes, [blue_color, light_blue_color, red_color, light_red_color])
+        confusion_matrix = [ [ true_negative, false_positive],
+                             [false_negative,  true_positive] ]
+        return G.centroids[nodes].tolist(), class_colors, confusion_matrix
+
     list_nodes = G.nodes()
 
     for g_idx, pred in enumerate(classes_pred):
@@ -353,6 +423,15 @@ def get_colors_by_pred_results_test_indices(G, classes_pred, test_indices):
     true_positive  = 0
     false_positive = 0
 
+    if isinstance(G, GlandGraph):
+        nodes = np.asarray(test_indices, dtype=int)
+        outcomes = _prediction_outcomes(G, nodes, np.asarray(classes_pred)[nodes])
+        class_colors, (true_negative, false_positive, true_positive, false_negative) = _outcome_colors(
+            outcomes, [color_not_demarcated_t, color_not_demarcated_f, color_demarcated_t, color_demarcated_f])
+        confusion_matrix = [ [ true_negative, false_positive],
+                             [false_negative,  true_positive] ]
+        return G.centroids[nodes].tolist(), class_colors, confusion_matrix
+
     list_nodes = G.nodes()
 
     for idx, g_idx in enumerate(test_indices):
@@ -379,4 +458,27 @@ def get_colors_by_pred_results_test_indices(G, classes_pred, test_indices):
     confusion_matrix = [ [ true_negative, false_positive],
                          [false_negative,  true_positive] ]
 
-    return position, class_colors, confusion_matrix
\ No newline at end of file
+    return position, class_colors, confusion_matrix
+
+def _prediction_outcomes(G, nodes, classes_pred):
+    '''Masks of the nodes of a GlandGraph that are (not demarcated, predicted 0), (not demarcated, 
+    predicted 1), (demarcated, predicted 1) and (demarcated, predicted 0). `classes_pred` contains 
+    the prediction of each node in `nodes`.'''
+
+    demarcated = G.demarcated[nodes]
+    outcomes = [~demarcated & (classes_pred==0), ~demarcated & (classes_pred==1),
+                demarcated & (classes_pred==1), demarcated & (classes_pred==0)]
+
+    return outcomes
+
+def _outcome_colors(outcomes, colors):
+    '''Color of each node with one of the `outcomes` (see _prediction_outcomes()), in node order, and
+    the number of nodes with each outcome.'''
+
+    node_colors = np.zeros((len(outcomes[0]), 3), dtype=int)
+    for outcome, color in zip(outcomes, colors):
+        node_colors[outcome] = color
+    has_outcome = np.logical_or.reduce(outcomes)
+    counts = [int(np.sum(outcome)) for outcome in outcomes]
+
+    return node_colors[has_outcome].tolist(), counts
@@ -0,0 +1,224 @@
+import os
+import json
+import zlib
+import multiprocessing
+from functools import lru_cache
+import numpy as np
+import networkx as nx
+import data_analysis_func as func
+from feature_store import read_feature_store
+from unbalanced_cv import get_fold_index_arrays, knn_k_sweep
+
+# Runner for the grids of experiments of the AppFindBestGeometricGraphRadius and
+# UnbalancedCrossValidation notebooks. Each cell of the grid is a (slide, radius, props_type,
+# realization) tuple, and all the k values are evaluated inside the cell with knn_k_sweep(). Cells
+# are independent and are spread across a pool of processes. The results of each cell are appended
+# to a JSON lines file as soon as the cell finishes, so an interrupted sweep can be resumed by calling
+# run_experiments() again with the same file.
+
+#Properties to be validated
+# Shapes  - 1
+# Network - 2
+# All     - 3
+# All idx - 4
+# Degree  - 5
+PROPERTIES_NAMES = {
+    1: ['area', 'diameter', 'perimeter', 'eccentricity', 'solidity'],
+    2: ['degree', 'betweenness', 'strength'],
+    3: ['area', 'diameter', 'perimeter', 'eccentricity', 'solidity', 'degree', 'betweenness', 'strength'],
+    4: ['idx', 'area', 'diameter', 'perimeter', 'eccentricity', 'solidity', 'degree', 'betweenness', 'strength'],
+    5: ['degree']
+}
+
+def graph_path(root, slide, radius):
+    '''Path of the GML file with the gland graph of `slide` for `radius`.'''
+
+    return f'{root}/{slide}/results_radius_{radius}/grafo_glands_properties_{radius}r.gml'
+
+def store_path(root, slide, radius):
+    '''Path of the feature store (see feature_store.py) of `slide` for `radius`.'''
+
+    return f'{root}/{slide}/results_radius_{radius}/feature_store'
+
+def cell_key(slide, radius, props_type, realization):
+    '''String identifying a cell of the grid.'''
+
+    return f'{slide}|{radius}|{props_type}|{realization}'
+
+def cell_seed(key, seed=0):
+    '''Seed of the random state used for the folds of a cell. It depends only on the cell and on
+    `seed`, so the results do not depend on the process or on the order in which cells are run.'''
+
+    return (zlib.crc32(key.encode()) + seed) % 2**32
+
+@lru_cache(maxsize=8)
+def _load_graph(root, slide, radius):
+    '''Load the graph of a slide, using the feature store if it exists. Each worker process keeps the
+    last graphs loaded, so the cells of the same slide and radius read the file only once.'''
+
+    path = store_path(root, slide, radius)
+    if os.path.isdir(path):
+        return read_feature_store(path)
+    return nx.read_gml(graph_path(root, slide, radius))
+
+@lru_cache(maxsize=32)
+def _load_table(root, slide, radius, props_type):
+    '''Normalized table of properties and classes of a slide for the given `props_type`.'''
+
+    properties_names = PROPERTIES_NAMES[props_type]
+    G = _load_graph(root, slide, radius)
+    table_properties_norm, classes = func.get_table_properties(G, properties_names, True, use_cache=True)
+    table_properties = func.remove_idx_from_table_properties(properties_names, table_properties_norm)
+
+    return table_properties, classes
+
+def _run_cell(args):
+    '''Run the k sweep of a single cell and return its results.'''
+
+    root, slide, radius, props_type, realization, ks, num_folds, seed = args
+
+    data, classes = _load_table(root, slide, radius, props_type)
+    key = cell_key(slide, radius, props_type, realization)
+    # get_fold_index_arrays() uses the global random state, which is restored afterwards so running the
+    # cells in the current process (processes=1) does not change the random state of the caller
+    random_state = np.random.get_state()
+    try:
+        np.random.seed(cell_seed(key, seed))
+        folds = get_fold_index_arrays(classes, num_folds)[0]
+    finally:
+        np.random.set_state(random_state)
+    classes_pred, test_indices = knn_k_sweep(data, classes, num_folds, ks, folds)
+
+    N2 = int(np.sum(classes))
+    N = len(classes)
+    result = {
+        "Key": key,
+        "Slide": slide,
+        "Radius": radius,
+        "Props Type": props_type,
+        "Realization": realization,
+        "Normal Glands": N - N2,
+        "Demarcated Glands": N2,
+        "Total Glands": N,
+        "K": list(ks),
+        "Num Folds": num_folds,
+        "Seed": seed,
+        "Root": root,
+        "Accuracy": (np.sum(classes==classes_pred, axis=1)/N).tolist(),
+        "Predicted Classes": classes_pred.tolist(),
+        "Test Indexes": test_indices
+    }
+
+    return result
+
+def load_results(filename):
+    '''Read the results written by run_experiments(). Incomplete lines, left by an interrupted run,
+    are ignored.'''
+
+    results = []
+    if not os.path.exists(filename):
+        return results
+    with open(filename) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    return results
+
+def run_experiments(slides, radii, props_types, ks, num_real, output_filename, num_folds=5,
+                    root='prostate_marked', processes=None, seed=0, print_progress=True):
+    '''Run the unbalanced cross-validation with a k-nearest neighbors classifier for all the
+    combinations of `slides`, `radii`, `props_types` and realizations, evaluating all the `ks` in each
+    combination.
+
+    Parameters
+    ----------
+    slides : list
+        Names of the slide directories inside `root`
+    radii : list
+        Radii of the geometric graphs
+    props_types : list
+        Sets of properties used as features (see PROPERTIES_NAMES)
+    ks : list
+        Numbers of neighbors of the classifier
+    num_real : int
+        Number of realizations of the cross-validation
+    output_filename : str
+        JSON lines file where the result of each cell is appended. Cells already in the file are not
+        run again. A ValueError is raised if the file has results of other `ks`, `num_folds`, `seed`
+        or `root`
+    num_folds : int
+        Number of folds of the cross-validation
+    root : str
+        Directory containing the slides
+    processes : int
+        Number of worker processes (all available cores if None). If 1, the cells are run in the
+        current process
+    seed : int
+        Base seed of the random states of the cells (see cell_seed())
+    print_progress : bool
+        Whether to print the accuracy of each cell as it finishes
+
+    Returns
+    -------
+    results : list
+        Results of all the cells of the grid, including those loaded from `output_filename`
+    '''
+
+    if processes is None:
+        processes = os.cpu_count()
+    ks = [int(k) for k in ks]
+    num_folds = int(num_folds)
+    seed = int(seed)
+
+    results = load_results(output_filename)
+    settings = {"K": ks, "Num Folds": num_folds, "Seed": seed, "Root": root}
+    for result in results:
+        for name, value in settings.items():
+            if result.get(name) != value:
+                raise ValueError(f"{output_filename} has results with {name} = {result.get(name)}, "
+                                 f"not {value}. Use another output file")
+    done = set(result["Key"] for result in results)
+
+    # Cells of the same slide and radius are contiguous, so each chunk sent to a worker
+    # loads few graphs
+    cells = []
+    for slide in slides:
+        for radius in radii:
+            for props_type in props_types:
+                for realization in range(num_real):
+                    if cell_key(slide, radius, props_type, realization) not in done:
+                        cells.append((root, slide, radius, props_type, realization, ks, num_folds, seed))
+    if len(cells) == 0:
+        return results
+
+    chunksize = max(1, min(num_real*len(props_types), len(cells)//(4*processes)))
+    if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0:
+        with open(output_filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            # Line left incomplete by an interrupted run
+            incomplete = f.read(1) != b'\n'
+    else:
+        incomplete = False
+    with open(output_filename, 'a') as f_out:
+        if incomplete:
+            f_out.write('\n')
+        def save(cell_results):
+            for result in cell_results:
+                f_out.write(json.dumps(result) + '\n')
+                f_out.flush()
+                results.append(result)
+                if print_progress:
+                    print("Slide: %s - Radius: %d - Props: %d - Realization: %d - Best accuracy: %3.2f" % (
+                          result["Slide"], result["Radius"], result["Props Type"], result["Realization"],
+                          np.max(result["Accuracy"])))
+
+        if processes == 1:
+            save(map(_run_cell, cells))
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                save(pool.imap_unordered(_run_cell, cells, chunksize))
+
+    return results
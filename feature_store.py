@@ -0,0 +1,156 @@
+import os
+import json
+import numpy as np
+import networkx as nx
+
+# Columnar binary storage of the gland properties and of the weighted gland graph. A store is a
+# directory containing one .npy file for each node attribute column, the CSR adjacency of the graph
+# (indptr.npy, indices.npy, weights.npy) and a small JSON header. The arrays can be memory-mapped,
+# so loading a store does not parse any text.
+
+STORE_HEADER = 'store.json'
+STORE_VERSION = 1
+
+def edges_to_csr(edges, weights, num_nodes):
+    '''Return the symmetric CSR adjacency (indptr, indices, weights) of an undirected graph with edges
+    given as an [E,2] array of node indices. Neighbors of each node are sorted by index.'''
+
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if weights is None:
+        weights = np.ones(len(edges))
+    weights = np.asarray(weights, dtype=float)
+
+    rows = np.concatenate((edges[:,0], edges[:,1]))
+    cols = np.concatenate((edges[:,1], edges[:,0]))
+    vals = np.concatenate((weights, weights))
+    order = np.lexsort((cols, rows))
+
+    indptr = np.zeros(num_nodes+1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    indices = cols[order].astype(np.int32)
+
+    return indptr, indices, vals[order]
+
+def csr_to_edges(indptr, indices, weights):
+    '''Return each undirected edge of a symmetric CSR adjacency once, as an [E,2] array with the smaller
+    node index first, together with the edge weights.'''
+
+    rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    upper = rows < indices
+    edges = np.column_stack((rows[upper], indices[upper]))
+
+    return edges, np.asarray(weights)[upper]
+
+def write_feature_store(path, node_columns, edges, weights=None, num_nodes=None, path_gml=None):
+    '''Write gland properties and the gland graph to a feature store in directory `path`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store. It is created if it does not exist
+    node_columns : dict
+        Node attributes. Each key is an attribute name (e.g. 'area', 'degree', 'demarcated') and each
+        value an array with one element per node
+    edges : numpy array
+        [E,2] array containing the indices of the nodes of each edge
+    weights : numpy array
+        Weight of each edge. If None, all weights are 1
+    num_nodes : int
+        Number of nodes. If None, the length of the node columns is used
+    path_gml : str
+        If given, the graph is also exported to this GML file, with the same format used by the
+        grafo_glands_properties files
+    '''
+
+    if num_nodes is None:
+        num_nodes = len(next(iter(node_columns.values())))
+    os.makedirs(path, exist_ok=True)
+
+    columns = []
+    for name, values in node_columns.items():
+        values = np.asarray(values)
+        if len(values) != num_nodes:
+            raise ValueError(f"Column '{name}' has {len(values)} values but the graph has {num_nodes} nodes")
+        np.save(os.path.join(path, f'{name}.npy'), values)
+        columns.append(name)
+
+    indptr, indices, csr_weights = edges_to_csr(edges, weights, num_nodes)
+    np.save(os.path.join(path, 'indptr.npy'), indptr)
+    np.save(os.path.join(path, 'indices.npy'), indices)
+    np.save(os.path.join(path, 'weights.npy'), csr_weights)
+
+    header = {'version': STORE_VERSION, 'num_nodes': int(num_nodes), 'columns': columns}
+    with open(os.path.join(path, STORE_HEADER), 'w') as f:
+        json.dump(header, f)
+
+    if path_gml is not None:
+        nx.write_gml(feature_store_to_nx(read_feature_store(path, mmap=False)), path_gml)
+
+def read_feature_store(path, mmap=True):
+    '''Read the feature store in directory `path`. If `mmap` is True, the arrays are memory-mapped
+    instead of read into memory.
+
+    Returns
+    -------
+    store : dict
+        Dictionary with keys 'num_nodes', 'columns' (dict of node attribute arrays), 'indptr',
+        'indices' and 'weights' (CSR adjacency of the graph)
+    '''
+
+    with open(os.path.join(path, STORE_HEADER)) as f:
+        header = json.load(f)
+    if header['version'] != STORE_VERSION:
+        raise ValueError(f"Unsupported feature store version {header['version']}")
+
+    mmap_mode = 'r' if mmap else None
+    def load(name):
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    store = {
+        'num_nodes': header['num_nodes'],
+        'columns': {name:load(name) for name in header['columns']},
+        'indptr': load('indptr'),
+        'indices': load('indices'),
+        'weights': load('weights')
+    }
+
+    return store
+
+def feature_store_to_nx(store):
+    '''Return a networkx graph with the nodes, attributes and weighted edges of `store`. Boolean
+    columns are converted to the strings 'True'/'False', as in the grafo_glands_properties GML files.'''
+
+    nxgraph = nx.Graph()
+    columns = store['columns']
+    names = list(columns.keys())
+    values = [columns[name].tolist() if columns[name].dtype != bool else
+              [str(v) for v in columns[name].tolist()] for name in names]
+    for node in range(store['num_nodes']):
+        nxgraph.add_node(node, **{name:vals[node] for name, vals in zip(names, values)})
+
+    edges, weights = csr_to_edges(store['indptr'], store['indices'], store['weights'])
+    nxgraph.add_weighted_edges_from(zip(edges[:,0].tolist(), edges[:,1].tolist(), weights.tolist()))
+
+    return nxgraph
+
+def gml_to_feature_store(path_gml, path):
+    '''Convert a grafo_glands_properties GML file to a feature store in directory `path`. The
+    'demarcated' attribute is stored as a boolean column.'''
+
+    nxgraph = nx.read_gml(path_gml, label='id')
+    nodes = list(nxgraph)
+    node_index = {node:idx for idx, node in enumerate(nodes)}
+
+    node_columns = {}
+    if len(nodes) > 0:
+        for name in nxgraph.nodes[nodes[0]]:
+            if name == 'label':
+                continue
+            values = [nxgraph.nodes[node][name] for node in nodes]
+            if name == 'demarcated':
+                values = [value == 'True' for value in values]
+            node_columns[name] = np.array(values)
+
+    edges = np.array([(node_index[u], node_index[v]) for u, v in nxgraph.edges], dtype=np.int64)
+    weights = np.array([w for _, _, w in nxgraph.edges(data='weight', default=1.)], dtype=float)
+    write_feature_store(path, node_columns, edges, weights, num_nodes=len(nodes))
@@ -1,8 +1,8 @@
 import numpy as np
 from scipy.stats import zscore
-from scipy import ndimage as ndi
 from igraph import Graph
 from scipy.spatial import cKDTree as kdtree
+from glands import extract_glands
 
 def geometric_graph(positions, radius):
 
@@ -12,22 +12,73 @@ def geometric_graph(positions, radius):
 
     return g
 
-def network_from_mask(img_mask, radius):
-    '''Calculate voronoi network from a given mask image.'''
-    
-    lbl, nro = ndi.label(img_mask)
-    idx = np.array(range(1, nro+1, 1))
-    cm = ndi.measurements.center_of_mass(img_mask, lbl, idx)
-    
+def sorted_pairs(positions, max_radius):
+    '''Return all pairs of `positions` within distance `max_radius`, sorted by increasing distance,
+    together with their distances. The pairs within any radius r <= max_radius are a prefix of the
+    returned arrays (see pairs_within()), so a single neighbour query serves a whole radius sweep.'''
+
+    positions = np.asarray(positions, dtype=float)
+    tree = kdtree(positions)
+    pairs = tree.query_pairs(max_radius, output_type='ndarray')
+    dists = np.sqrt(np.sum((positions[pairs[:,0]]-positions[pairs[:,1]])**2, axis=1))
+
+    order = np.argsort(dists, kind='stable')
+
+    return pairs[order], dists[order]
+
+def pairs_within(pairs, dists, radius):
+    '''Return the prefix of the sorted `pairs` (see sorted_pairs()) with distance at most `radius`.'''
+
+    num_edges = np.searchsorted(dists, radius, side='right')
+
+    return pairs[:num_edges]
+
+def geometric_graph_multi_radius(positions, radii):
+    '''Return a list containing one geometric graph for each radius in `radii`. The neighbour
+    query is done only once, for the largest radius.'''
+
+    pairs, dists = sorted_pairs(positions, np.max(radii))
+    graphs = []
+    for radius in radii:
+        edges = pairs_within(pairs, dists, radius)
+        graphs.append(Graph(n=len(positions), edges=edges.tolist()))
+
+    return graphs
+
+def centers_of_mass(img_mask, glands=None):
+    '''Return the center of mass of each object in `img_mask`, rotated to the (x, y) coordinates
+    used for the graph nodes. If `glands` (see glands.extract_glands()) is given, its centroids are
+    used instead of labeling the mask again.'''
+
+    if glands is None:
+        glands = extract_glands(img_mask)
+
     #ROTATE CENTER OF MASS
-    cm = np.array(cm)
+    cm = np.array(glands.centroids)
     cm = cm[:,::-1]
     cm[:,1] = img_mask.shape[0]-cm[:,1]
 
+    return cm
+
+def network_from_mask(img_mask, radius, glands=None):
+    '''Calculate voronoi network from a given mask image. If `glands` is given, the labeling done by
+    glands.extract_glands() is reused.'''
+
+    cm = centers_of_mass(img_mask, glands)
     g = geometric_graph(cm, radius)
-    
+
     return g, cm
 
+def networks_from_mask(img_mask, radii, glands=None):
+    '''Calculate the geometric networks for every radius in `radii` from a given mask image. The
+    mask is labeled once (or `glands` is reused) and the neighbour query is done only for the largest 
+    radius. Returns the list of graphs, in the same order as `radii`, and the centers of mass.'''
+
+    cm = centers_of_mass(img_mask, glands)
+    graphs = geometric_graph_multi_radius(cm, radii)
+
+    return graphs, cm
+
 if __name__=="__main__":
 
     # Test the code with random points
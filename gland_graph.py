@@ -0,0 +1,169 @@
+import numpy as np
+import networkx as nx
+from feature_store import edges_to_csr, csr_to_edges, read_feature_store, write_feature_store
+
+# Node attributes of the grafo_glands_properties graphs that are not feature columns
+_POSITION_ATTRIBUTES = ('row', 'column')
+_CLASS_ATTRIBUTE = 'demarcated'
+
+class GlandGraph:
+    '''Gland graph stored in arrays. Node i is the i-th gland and all node data are arrays indexed
+    by i, so there are no string ids and no dictionaries per node.
+
+    Attributes
+    ----------
+    indptr, indices, weights : numpy array
+        Symmetric CSR adjacency of the graph (see feature_store.edges_to_csr()). The neighbors of
+        node i are indices[indptr[i]:indptr[i+1]]
+    columns : dict
+        Feature columns (e.g. 'area', 'degree'), each one a float array with one value per node.
+        The 'idx' column, if present, is an integer array
+    demarcated : numpy array
+        Boolean array indicating the glands demarcated by the expert
+    centroids : numpy array
+        [N,2] integer array with the (row, column) position of each gland
+    '''
+
+    __slots__ = ('indptr', 'indices', 'weights', 'columns', 'demarcated', 'centroids', '__weakref__')
+
+    def __init__(self, indptr, indices, weights, columns, demarcated, centroids):
+
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.weights = np.asarray(weights)
+        self.columns = dict(columns)
+        self.demarcated = np.asarray(demarcated, dtype=bool)
+        self.centroids = np.asarray(centroids, dtype=np.int32).reshape(-1, 2)
+
+    @classmethod
+    def from_edges(cls, edges, weights, num_nodes, columns, demarcated, centroids):
+        '''Create a GlandGraph from an [E,2] array of edges and the weight of each edge.'''
+
+        indptr, indices, csr_weights = edges_to_csr(edges, weights, num_nodes)
+
+        return cls(indptr, indices, csr_weights, columns, demarcated, centroids)
+
+    @classmethod
+    def from_nx(cls, nxgraph, dtype=np.float64):
+        '''Create a GlandGraph from a networkx graph with the attributes of the grafo_glands_properties
+        files. Nodes are numbered in the order of `nxgraph`. `dtype` is the type of the feature
+        columns (np.float64 or np.float32).'''
+
+        nodes = list(nxgraph)
+        num_nodes = len(nodes)
+        node_index = {node:idx for idx, node in enumerate(nodes)}
+        node_data = [nxgraph.nodes[node] for node in nodes]
+
+        columns = {}
+        names = list(node_data[0]) if num_nodes > 0 else []
+        for name in names:
+            if name == 'label' or name == _CLASS_ATTRIBUTE or name in _POSITION_ATTRIBUTES:
+                continue
+            column_dtype = np.int64 if name == 'idx' else dtype
+            columns[name] = np.array([data[name] for data in node_data], dtype=column_dtype)
+
+        demarcated = np.array([data.get(_CLASS_ATTRIBUTE) in ('True', True) for data in node_data], dtype=bool)
+        centroids = np.array([[data.get('row', 0), data.get('column', 0)] for data in node_data], dtype=np.int32)
+
+        edges = np.array([(node_index[u], node_index[v]) for u, v in nxgraph.edges], dtype=np.int64)
+        weights = np.array([w for _, _, w in nxgraph.edges(data='weight', default=1.)], dtype=float)
+
+        return cls.from_edges(edges, weights, num_nodes, columns, demarcated, centroids)
+
+    @classmethod
+    def read_gml(cls, path_gml, dtype=np.float64):
+        '''Read a grafo_glands_properties GML file.'''
+
+        return cls.from_nx(nx.read_gml(path_gml), dtype)
+
+    @classmethod
+    def from_store(cls, store):
+        '''Create a GlandGraph from a feature store (see feature_store.read_feature_store()). The arrays
+        are not copied, so they remain memory-mapped if the store was.'''
+
+        if isinstance(store, str):
+            store = read_feature_store(store)
+        columns = dict(store['columns'])
+        demarcated = columns.pop(_CLASS_ATTRIBUTE, np.zeros(store['num_nodes'], dtype=bool))
+        if all(name in columns for name in _POSITION_ATTRIBUTES):
+            centroids = np.column_stack([columns.pop(name) for name in _POSITION_ATTRIBUTES])
+        else:
+            centroids = np.zeros((store['num_nodes'], 2), dtype=np.int32)
+
+        return cls(store['indptr'], store['indices'], store['weights'], columns, demarcated, centroids)
+
+    def to_store(self, path, path_gml=None):
+        '''Write the graph to a feature store in directory `path` (see feature_store.write_feature_store()).'''
+
+        edges, weights = self.edges()
+        write_feature_store(path, self._node_columns(), edges, weights, self.num_nodes, path_gml)
+
+    def to_nx(self):
+        '''Return a networkx graph with integer nodes and the attributes of the grafo_glands_properties
+        files, with 'demarcated' as the strings 'True'/'False'.'''
+
+        node_columns = self._node_columns()
+        names = list(node_columns)
+        values = [node_columns[name].tolist() for name in names]
+        values[names.index(_CLASS_ATTRIBUTE)] = [str(value) for value in self.demarcated.tolist()]
+
+        nxgraph = nx.Graph()
+        nxgraph.add_nodes_from((node, dict(zip(names, node_values)))
+                               for node, node_values in enumerate(zip(*values)))
+        edges, weights = self.edges()
+        nxgraph.add_weighted_edges_from(zip(edges[:,0].tolist(), edges[:,1].tolist(), weights.tolist()))
+
+        return nxgraph
+
+    def _node_columns(self):
+        '''All node attributes as columns, in the order of the grafo_glands_properties files.'''
+
+        node_columns = {}
+        if 'idx' in self.columns:
+            node_columns['idx'] = self.columns['idx']
+        node_columns['row'] = self.centroids[:,0]
+        node_columns['column'] = self.centroids[:,1]
+        node_columns[_CLASS_ATTRIBUTE] = self.demarcated
+        for name, values in self.columns.items():
+            if name != 'idx':
+                node_columns[name] = values
+
+        return node_columns
+
+    @property
+    def num_nodes(self):
+
+        return len(self.indptr) - 1
+
+    def __len__(self):
+
+        return self.num_nodes
+
+    def number_of_edges(self):
+
+        return len(self.indices)//2
+
+    def column(self, name):
+        '''Values of node attribute `name` for all nodes, including 'row', 'column' and 'demarcated'.'''
+
+        if name == _CLASS_ATTRIBUTE:
+            return self.demarcated
+        if name in _POSITION_ATTRIBUTES:
+            return self.centroids[:, _POSITION_ATTRIBUTES.index(name)]
+        return self.columns[name]
+
+    def neighbors(self, node):
+        '''Neighbors of `node` and the weights of the corresponding edges.'''
+
+        start, stop = self.indptr[node], self.indptr[node+1]
+
+        return self.indices[start:stop], self.weights[start:stop]
+
+    def edges(self):
+        '''Return each edge once, as an [E,2] array with the smaller node first, and the edge weights.'''
+
+        return csr_to_edges(self.indptr, self.indices, self.weights)
+
+    def __repr__(self):
+
+        return f'GlandGraph({self.num_nodes} nodes, {self.number_of_edges()} edges, columns={list(self.columns)})'
@@ -0,0 +1,26 @@
+import numpy as np
+from collections import namedtuple
+from scipy import ndimage as ndi
+
+# Result of the gland extraction stage, shared by graph building and shape measurement
+#   label_img : label image, gland i has label i+1
+#   count     : number of glands
+#   centroids : [count,2] array, center of mass (row, col) of each gland weighted by the mask values
+#   bboxes    : [count,4] array, (min_row, min_col, max_row+1, max_col+1) of each gland
+Glands = namedtuple('Glands', ['label_img', 'count', 'centroids', 'bboxes'])
+
+def extract_glands(img_mask, connectivity=1):
+    '''Label the glands of `img_mask` once and return a Glands tuple with the label image, the number
+    of glands, their centroids and bounding boxes. `connectivity` is 1 for 4-connected and 2 for
+    8-connected glands. Glands are numbered in raster order of their first pixel, so the same
+    order is used by the graph nodes (geometric_graph.network_from_mask()) and by the rows of the
+    shape properties table (prop.get_shape_props_from_mask()).'''
+
+    structure = ndi.generate_binary_structure(2, connectivity)
+    label_img, count = ndi.label(img_mask, structure)
+    idx = np.arange(1, count+1)
+    centroids = np.array(ndi.center_of_mass(img_mask, label_img, idx)).reshape(-1, 2)
+    slices = ndi.find_objects(label_img, count)
+    bboxes = np.array([[s[0].start, s[1].start, s[0].stop, s[1].stop] for s in slices], dtype=int).reshape(-1, 4)
+
+    return Glands(label_img, count, centroids, bboxes)
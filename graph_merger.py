@@ -2,12 +2,20 @@ import networkx as nx
 
 def filename_to_label(filename):
     """Given a filename, returns a label to be added to nodes indices"""
-    
+
     node_label = filename.split('.')[0].split('/')[1]
 
     return node_label
 
-def merge_graphs(input_filenames, output_filename):
+def merge_graphs(input_filenames, output_filename, streaming=True):
+    """Write the union of the graphs in `input_filenames` to `output_filename`. Node labels are
+    prefixed by the slide name (see filename_to_label()). If `streaming` is True, the GML records
+    are streamed from the input files (see merge_graphs_streaming()); otherwise the graphs are
+    loaded into networkx and merged with nx.union_all."""
+
+    if streaming:
+        merge_graphs_streaming(input_filenames, output_filename)
+        return
 
     graphs = []
     graphs_names = []
@@ -15,5 +23,133 @@ def merge_graphs(input_filenames, output_filename):
         graphs.append(nx.read_gml(filename))
         graphs_names.append(f'{filename_to_label(filename)}-')
 
-    graph_union = nx.union_all(graphs, rename=graphs_names)   
-    nx.write_gml(graph_union, output_filename)
\ No newline at end of file
+    graph_union = nx.union_all(graphs, rename=graphs_names)
+    nx.write_gml(graph_union, output_filename)
+
+def merge_graphs_streaming(input_filenames, output_filename):
+    """Merge GML graphs without building them in memory. Node and edge records are copied one at a
+    time from each input file; node ids and edge endpoints are offset so that the ids of different
+    files do not overlap, and each node label becomes '<slide>-<label>', as with merge_graphs(). Time
+    and memory are linear in the total size of the graphs (memory is constant apart from the current
+    record). The input files must be written by networkx (one key per line)."""
+
+    written_graph_keys = set()
+    offset = 0
+    with open(output_filename, 'w') as f_out:
+        f_out.write('graph [\n')
+        for filename in input_filenames:
+            prefix = f'{filename_to_label(filename)}-'
+            max_id = -1
+            for kind, lines in _iter_gml_records(filename):
+                if kind == 'node':
+                    lines, node_id = _relabel_node(lines, offset, prefix)
+                    max_id = max(max_id, node_id)
+                elif kind == 'edge':
+                    lines = _offset_edge(lines, offset)
+                else:
+                    # Graph attributes, the first file defining each key is kept
+                    if kind in written_graph_keys:
+                        continue
+                    written_graph_keys.add(kind)
+                f_out.writelines(lines)
+            offset += max_id + 1
+        f_out.write(']\n')
+
+def _iter_gml_records(filename):
+    """Yield the records inside the graph of a GML file as (kind, lines) pairs. `kind` is 'node',
+    'edge' or, for graph attributes, the attribute name."""
+
+    depth = 0
+    record_kind = None
+    record_lines = []
+    with open(filename) as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            opens = stripped.endswith('[')
+            closes = stripped == ']'
+
+            if depth == 0:
+                if opens:
+                    depth = 1
+                continue
+
+            if depth == 1 and record_kind is None:
+                if closes:
+                    depth = 0
+                    continue
+                key = stripped.split(None, 1)[0]
+                if opens:
+                    record_kind = key
+                    record_lines = [line]
+                    depth += 1
+                else:
+                    yield key, [line]
+                continue
+
+            record_lines.append(line)
+            if opens:
+                depth += 1
+            elif closes:
+                depth -= 1
+                if depth == 1:
+                    yield record_kind, record_lines
+                    record_kind = None
+
+def _relabel_node(lines, offset, prefix):
+    """Offset the id of a node record and add `prefix` to its label."""
+
+    new_lines = []
+    node_id = None
+    label_line = None
+    for depth, key, value, line in _iter_record_keys(lines):
+        if depth == 1 and key == 'id':
+            node_id = int(value)
+            indent = line[:len(line)-len(line.lstrip())]
+            line = f'{indent}id {node_id+offset}\n'
+        elif depth == 1 and key == 'label':
+            indent = line[:len(line)-len(line.lstrip())]
+            label = value[1:-1] if value.startswith('"') else value
+            label_line = len(new_lines)
+            line = f'{indent}label "{prefix}{label}"\n'
+        new_lines.append(line)
+
+    if node_id is None:
+        raise ValueError('GML node without id')
+    if label_line is None:
+        # networkx uses the id as label when it is missing
+        indent = new_lines[1][:len(new_lines[1])-len(new_lines[1].lstrip())] if len(new_lines) > 2 else '    '
+        new_lines.insert(1, f'{indent}label "{prefix}{node_id}"\n')
+
+    return new_lines, node_id
+
+def _offset_edge(lines, offset):
+    """Offset the source and target of an edge record."""
+
+    new_lines = []
+    for depth, key, value, line in _iter_record_keys(lines):
+        if depth == 1 and key in ('source', 'target'):
+            indent = line[:len(line)-len(line.lstrip())]
+            line = f'{indent}{key} {int(value)+offset}\n'
+        new_lines.append(line)
+
+    return new_lines
+
+def _iter_record_keys(lines):
+    """Yield (depth, key, value, line) for the lines of a record, where depth 1 corresponds to the
+    keys directly inside the record."""
+
+    depth = 0
+    for line in lines:
+        stripped = line.strip()
+        tokens = stripped.split(None, 1)
+        key = tokens[0]
+        value = tokens[1] if len(tokens) > 1 else ''
+        if stripped == ']':
+            depth -= 1
+            yield depth, key, value, line
+            continue
+        yield depth, key, value, line
+        if stripped.endswith('['):
+            depth += 1
@@ -3,30 +3,138 @@ import matplotlib.pyplot as plt
 import numpy as np
 from skimage import io
 import scipy.ndimage as ndi
+import networkx as nx
+import prop
 
-def binary_dilation_no_merge(img_mask, iterations):
+def binary_dilation_no_merge(img_mask, iterations, strip_rows=512):
     """Dilates image avoiding merging of objects. img_mask must have value 255 for 
-    glands and 0 for background."""
-    
-    img_dist, closest_indices = ndi.distance_transform_edt(255-img_mask, return_distances=True, return_indices=True)
+    glands and 0 for background.
+
+    The image is processed in strips of `strip_rows` rows (see binary_dilation_no_merge_sweep()),
+    so besides a few arrays of the size of the image with compact dtypes, only arrays of the size 
+    of a strip are allocated."""
+
+    return binary_dilation_no_merge_sweep(img_mask, [iterations], strip_rows=strip_rows)[0]
+
+def binary_dilation_no_merge_sweep(img_mask, iterations_list, return_labels=False, strip_rows=512):
+    """Dilates image avoiding merging of objects for each number of iterations in `iterations_list`.
+    The distance to the closest gland and the partition of the image into the cells of the glands 
+    are calculated only once, and each level only needs a threshold and the labeling of the 
+    background. The results are the same as calling binary_dilation_no_merge() for each level.
+    img_mask must have value 255 for glands and 0 for background.
+
+    The feature transform is calculated on strips of `strip_rows` rows, with a margin of 
+    max(iterations_list)+2 rows that contains the closest gland of every pixel that can be dilated.
+
+    If `return_labels` is True, instead of masks the function returns label images where each 
+    dilated gland has the label of the original gland in ndi.label(img_mask, np.ones((3, 3))), 
+    the labeling used by remove_objects(). Background holes filled in the dilated mask that are 
+    farther than the dilation distance of the level from every gland get label 0."""
+
+    max_dist2_list = [_max_squared_distance(iterations) for iterations in iterations_list]
+    img_dist2, img_limits, img_cells = _dilation_partition(img_mask, max(iterations_list), max(max_dist2_list), 
+                                                           return_labels, strip_rows)
+
+    results = []
+    for max_dist2 in max_dist2_list:
+        img_mask_dil_sep_inv = img_dist2 > max_dist2
+        img_mask_dil_sep_inv |= img_limits
+        img_mask_final = _fill_separated(img_mask_dil_sep_inv)
+        del img_mask_dil_sep_inv
+        if return_labels:
+            results.append(np.where(img_dist2 <= max_dist2, img_cells, 0)*(img_mask_final > 0))
+        else:
+            results.append(img_mask_final)
+
+    return results
+
+def _dilation_partition(img_mask, max_iterations, max_dist2, return_cells, strip_rows):
+    """Squared distance from each pixel to the closest gland, clipped to max_dist2+1, and limits
+    between the cells of the glands. The cell image (the label of the closest gland of each pixel)
+    is also returned if `return_cells` is True, otherwise None is returned in its place. Only 
+    pixels closer than `max_iterations` to some gland have a valid cell."""
+
+    height, width = img_mask.shape
+    margin = int(np.ceil(max(max_iterations, 0))) + 2
+    dist2_clip = max_dist2 + 1
+    dtype_dist2 = np.uint16 if dist2_clip < 2**16 else np.uint32
+
     img_label, num_comp = ndi.label(img_mask, np.ones((3, 3)))
-    img_cells = img_label[(closest_indices[0].ravel(), closest_indices[1].ravel())].reshape(img_label.shape)
-    gradient = img_der = np.gradient(img_cells)
-    img_limits = np.maximum(np.abs(gradient[0]), np.abs(gradient[1]))>0
+    img_dist2 = np.full((height, width), dist2_clip, dtype=dtype_dist2)
+    img_limits = np.zeros((height, width), dtype=bool)
+    img_cells = np.zeros((height, width), dtype=img_label.dtype) if return_cells else None
+    for r0 in range(0, height, strip_rows):
+        r1 = min(r0+strip_rows, height)
+        w0, w1 = max(r0-margin, 0), min(r1+margin, height)
+        not_glands = img_mask[w0:w1] != 255
+        if not_glands.all():
+            # All pixels of the strip are farther than max_iterations from the glands
+            continue
+        closest_indices = ndi.distance_transform_edt(not_glands, return_distances=False, return_indices=True)
+        closest_indices[0] += w0
 
-    structure = [[0, 1, 0],[1, 1, 1],[0, 1, 0]]
-    #img_mask_dil = ndi.binary_dilation(img_mask, structure=structure, iterations=iterations)
-    img_mask_dil = img_dist<=iterations
-    img_mask_dil_sep = img_mask_dil*np.logical_not(img_limits)
+        # Squared distance to the closest gland of each pixel in the strip
+        rows = np.arange(r0, r1)[:,None]
+        cols = np.arange(width)[None,:]
+        drow = (closest_indices[0, r0-w0:r1-w0] - rows).astype(np.int64)
+        dcol = (closest_indices[1, r0-w0:r1-w0] - cols).astype(np.int64)
+        img_dist2[r0:r1] = np.minimum(drow*drow + dcol*dcol, dist2_clip)
+        del drow, dcol
+
+        # Cells of the strip plus one row above and below, used for finding the cell limits
+        c0, c1 = max(r0-1, 0), min(r1+1, height)
+        strip_cells = img_label[closest_indices[0, c0-w0:c1-w0], closest_indices[1, c0-w0:c1-w0]]
+        del closest_indices
+        img_limits[r0:r1] = _cell_limits(strip_cells, r0, r1, c0, height)
+        if return_cells:
+            img_cells[r0:r1] = strip_cells[r0-c0:r1-c0]
+
+    return img_dist2, img_limits, img_cells
+
+def _fill_separated(img_mask_dil_sep_inv):
+    """Return the mask (0 or 255) of all pixels that are not in the largest connected component 
+    of `img_mask_dil_sep_inv`."""
 
-    img_mask_dil_sep_inv = np.logical_not(img_mask_dil_sep)
     img_label_sep, num_comp = ndi.label(img_mask_dil_sep_inv, np.ones((3, 3)))
-    tam_comps = ndi.sum(img_mask_dil_sep_inv, img_label_sep, index=range(1, num_comp+1))
+    tam_comps = np.bincount(img_label_sep.ravel(), minlength=num_comp+1)[1:]
     larg_comp_idx = np.argmax(tam_comps) + 1
-    img_mask_final = 255*np.logical_not(img_label_sep==larg_comp_idx).astype(np.uint8)
-    
+    img_mask_final = (img_label_sep != larg_comp_idx).view(np.uint8)
+    img_mask_final *= 255
+
     return img_mask_final
 
+def _max_squared_distance(iterations):
+    """Largest squared distance d2 such that a pixel at distance sqrt(d2) from a gland is dilated.
+    The comparison is the same done on the float distances of ndi.distance_transform_edt()."""
+
+    if iterations < 0:
+        return -1
+    max_dist2 = int(np.floor(iterations*iterations))
+    while np.sqrt(np.float64(max_dist2+1)) <= iterations:
+        max_dist2 += 1
+    while max_dist2 >= 0 and np.sqrt(np.float64(max_dist2)) > iterations:
+        max_dist2 -= 1
+
+    return max_dist2
+
+def _cell_limits(img_cells, r0, r1, c0, height):
+    """Pixels of rows r0 to r1-1 where the cell image changes, that is, where np.gradient() of the 
+    cell image would be nonzero. `img_cells` contains the rows c0 to c0+len(img_cells)-1 of the
+    cell image, which must include the rows adjacent to the strip."""
+
+    rows = np.arange(r0, r1)
+    rows_before = np.maximum(rows-1, 0) - c0
+    rows_after = np.minimum(rows+1, height-1) - c0
+    img_limits = img_cells[rows_after] != img_cells[rows_before]
+
+    strip = img_cells[r0-c0:r1-c0]
+    width = strip.shape[1]
+    if width > 1:
+        img_limits[:,1:-1] |= strip[:,2:] != strip[:,:-2]
+        img_limits[:,0] |= strip[:,1] != strip[:,0]
+        img_limits[:,-1] |= strip[:,-1] != strip[:,-2]
+
+    return img_limits
 
 def remove_objects(img_mask, fraction_to_remove):
     """Randomly remove some objects from the image. fraction_to_remove sets the
@@ -42,3 +150,38 @@ def remove_objects(img_mask, fraction_to_remove):
     img_mask_rem_comps = mask[img_label].astype(np.uint8)
     
     return img_mask_rem_comps
+
+def remove_objects_from_graph(nxgraph, fraction_to_remove, processes=None, pivots=None, epsilon=None, seed=None):
+    """Randomly remove some glands from a gland graph with properties (e.g. read from a 
+    grafo_glands_properties GML file) without going back to the image. The glands are drawn as in 
+    remove_objects(), with the nodes in the order of the graph. Each removed edge updates the 
+    'degree' and 'strength' attributes of the remaining node, and only the betweenness, which 
+    depends on all shortest paths, is calculated again (see prop.betweenness_centrality_parallel() 
+    for the parameters). The shape attributes and the weights of the remaining edges are kept.
+
+    Returns the new graph and the list of removed nodes. `nxgraph` is not modified."""
+
+    nodes = list(nxgraph)
+    num_comp = len(nodes)
+    number_to_remove = int(round(fraction_to_remove*num_comp))
+    mask = np.random.permutation([0]*number_to_remove + [1]*(num_comp-number_to_remove))
+    removed_nodes = [node for node, keep in zip(nodes, mask) if keep == 0]
+
+    nxgraph_rem = nxgraph.copy()
+    removed = set(removed_nodes)
+    for node in removed_nodes:
+        for neighbor, edge_data in nxgraph_rem.adj[node].items():
+            if neighbor in removed:
+                continue
+            neighbor_data = nxgraph_rem.nodes[neighbor]
+            if 'degree' in neighbor_data:
+                neighbor_data['degree'] -= 1
+            if 'strength' in neighbor_data:
+                neighbor_data['strength'] -= edge_data.get('weight', 1)
+    nxgraph_rem.remove_nodes_from(removed_nodes)
+
+    betweenness = prop.betweenness_centrality_parallel(nxgraph_rem, weight='weight', processes=processes, 
+                                                       pivots=pivots, epsilon=epsilon, seed=seed)
+    nx.set_node_attributes(nxgraph_rem, betweenness, 'betweenness')
+
+    return nxgraph_rem, removed_nodes
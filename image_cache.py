@@ -0,0 +1,109 @@
+import os
+import json
+import numpy as np
+from skimage import io
+import misc
+
+# Cache of decoded slide images. Each image is decoded once (and corrected with misc.mask_correction()
+# if it is a mask) and stored as an uncompressed .npy file, together with downsampled pyramid levels.
+# The files are opened memory-mapped, so later runs open them without decoding and all the processes
+# reading the same image share its pages. A cached image is rebuilt when the size or the modification
+# time of the source file changes.
+
+def cache_paths(path, correct_mask=False, level=0, cache_dir=None):
+    '''Paths of the array and of the header of a cached image. The cache is stored by default in
+    the directory .image_cache next to the source image.'''
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), '.image_cache')
+    name = os.path.basename(path) + ('.corrected' if correct_mask else '')
+    path_array = os.path.join(cache_dir, f'{name}.L{level}.npy')
+    path_header = os.path.join(cache_dir, f'{name}.json')
+
+    return path_array, path_header
+
+def load_image(path, correct_mask=False, level=0, cache_dir=None):
+    '''Return image `path` as a read-only memory-mapped array, decoding it and building the pyramid
+    levels up to `level` only if they are not in the cache. If `correct_mask` is True, the image is a 
+    mask and the corrected mask is returned (see misc.mask_correction()). Level l is downsampled by 
+    2**l in each dimension: masks by the maximum of each 2x2 block, so small glands are not lost, and 
+    other images by the mean of each block.'''
+
+    build_image_cache(path, correct_mask, level, cache_dir)
+    path_array, _ = cache_paths(path, correct_mask, level, cache_dir)
+
+    return np.load(path_array, mmap_mode='r')
+
+def load_slide_images(root, level=0, cache_dir=None):
+    '''Return the image, the corrected glands mask and the corrected expert demarcation of the slide in
+    directory `root` (IMG.jpg, MASK.jpg and CA MASK.jpg), memory-mapped from the cache.'''
+
+    img = load_image(root + '/IMG.jpg', False, level, cache_dir)
+    mask = load_image(root + '/MASK.jpg', True, level, cache_dir)
+    expert_demarcation = load_image(root + '/CA MASK.jpg', True, level, cache_dir)
+
+    return img, mask, expert_demarcation
+
+def build_image_cache(path, correct_mask=False, levels=0, cache_dir=None):
+    '''Store image `path` and its pyramid levels 1 to `levels` in the cache, if they are not already
+    there and up to date.'''
+
+    path_array, path_header = cache_paths(path, correct_mask, 0, cache_dir)
+    stat = os.stat(path)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'correct_mask': correct_mask}
+
+    header = None
+    if os.path.exists(path_header):
+        with open(path_header) as f:
+            header = json.load(f)
+    if header is None or header['source'] != source or not os.path.exists(path_array):
+        img = io.imread(path)
+        if correct_mask:
+            img = misc.mask_correction(img)
+        os.makedirs(os.path.dirname(path_array), exist_ok=True)
+        _save_array(path_array, img)
+        del img
+        header = {'source': source, 'levels': 0}
+        _save_header(path_header, header)
+
+    for level in range(header['levels']+1, levels+1):
+        src = np.load(cache_paths(path, correct_mask, level-1, cache_dir)[0], mmap_mode='r')
+        path_level, _ = cache_paths(path, correct_mask, level, cache_dir)
+        _save_downsampled(path_level, src, correct_mask)
+        header['levels'] = level
+        _save_header(path_header, header)
+
+def _save_array(path_array, img):
+    '''Write `img` to a .npy file, replacing the previous file only when the new one is complete.'''
+
+    tmp_path = f'{path_array}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(img))
+    os.replace(tmp_path, path_array)
+
+def _save_header(path_header, header):
+
+    tmp_path = f'{path_header}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_path, path_header)
+
+def _save_downsampled(path_array, src, is_mask, strip_rows=1024):
+    '''Write `src` downsampled by 2 in each dimension to a .npy file, processing `strip_rows` output
+    rows at a time so the full image is never loaded. A last odd row or column is dropped.'''
+
+    height, width = src.shape[0]//2, src.shape[1]//2
+    tmp_path = f'{path_array}.{os.getpid()}.tmp'
+    dst = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=src.dtype, shape=(height, width)+src.shape[2:])
+    for r0 in range(0, height, strip_rows):
+        r1 = min(r0+strip_rows, height)
+        block = np.asarray(src[2*r0:2*r1, :2*width])
+        block = block.reshape((r1-r0, 2, width, 2) + src.shape[2:])
+        if is_mask:
+            dst[r0:r1] = block.max(axis=(1, 3))
+        else:
+            # Rounded mean of each 2x2 block
+            dst[r0:r1] = ((block.sum(axis=(1, 3), dtype=np.int64) + 2)//4).astype(src.dtype)
+    dst.flush()
+    del dst
+    os.replace(tmp_path, path_array)
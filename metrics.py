@@ -0,0 +1,112 @@
+import numpy as np
+
+# Confusion matrices and classification metrics for many sets of predictions at once, e.g. the
+# predictions of all realizations, k values and radii of an experiment (see unbalanced_cv.knn_k_sweep()
+# and experiment_runner.run_experiments()). Class 1 (demarcated gland) is the positive class and the
+# confusion matrices have the layout
+#   [ [ true_negative, false_positive],
+#     [false_negative,  true_positive] ]
+# with rows indexed by the true class and columns by the predicted class. This is the layout of
+# data_analysis_func.get_colors_by_pred_results_test_indices(). data_analysis_func.get_colors_by_pred_results()
+# counts a not demarcated gland predicted as 1 as a false negative, so its off-diagonal cells are
+# swapped and its matrices cannot be compared directly with these ones.
+
+#COLOR SCHEME - https://colorbrewer2.org/?type=qualitative&scheme=Set1&n=5
+OUTCOME_COLORS = np.array([[[55,126,184],    #not demarcated    - TRUE NEGATIVE  (HEALTHY)
+                            [255,240,30]],   #not demarcated    - FALSE POSITIVE (WRONG UNHEALTHY)
+                           [[57,184,55],     #demarcated        - FALSE NEGATIVE (WRONG HEALTHY)
+                            [228,26,28]]])   #demarcated        - TRUE  POSITIVE (UNHEALTHY)
+
+def confusion_matrices(classes_pred, classes):
+    '''Return the confusion matrices of many sets of predictions.
+
+    Parameters
+    ----------
+    classes_pred : numpy array
+        [R,N] array with the class (0 or 1) predicted for each of the N glands in each of the R runs.
+        Glands that were not tested in a run have class -1 and are not counted. A 1D array is taken as
+        a single run
+    classes : numpy array
+        True class of each gland (bool or 0/1)
+
+    Returns
+    -------
+    confusion_matrices : numpy array
+        [R,2,2] array with the confusion matrix of each run ([R,2,2] even for a single run)
+    '''
+
+    classes_pred = np.atleast_2d(classes_pred)
+    classes = np.asarray(classes).astype(int)
+    num_runs = classes_pred.shape[0]
+
+    tested = (classes_pred == 0) | (classes_pred == 1)
+    codes = 4*np.arange(num_runs)[:,None] + 2*classes[None,:] + classes_pred
+    counts = np.bincount(codes[tested], minlength=4*num_runs)
+
+    return counts.reshape(num_runs, 2, 2)
+
+def metrics_from_confusion(confusion_matrices):
+    '''Return the precision, recall, specificity and accuracy of each confusion matrix in an [R,2,2]
+    array, as a dictionary of arrays of length R. Metrics with a zero denominator are NaN.'''
+
+    confusion_matrices = np.asarray(confusion_matrices, dtype=float).reshape(-1, 2, 2)
+    tn = confusion_matrices[:,0,0]
+    fp = confusion_matrices[:,0,1]
+    fn = confusion_matrices[:,1,0]
+    tp = confusion_matrices[:,1,1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = {
+            "Precision": tp/(tp + fp),
+            "Recall": tp/(tp + fn),
+            "Specificity": tn/(tn + fp),
+            "Accuracy": (tp + tn)/(tp + tn + fp + fn)
+        }
+
+    return metrics
+
+def prediction_metrics(classes_pred, classes):
+    '''Return the confusion matrices (see confusion_matrices()) and the metrics (see
+    metrics_from_confusion()) of an [R,N] array of predictions. The accuracy only considers the tested
+    glands of each run.'''
+
+    matrices = confusion_matrices(classes_pred, classes)
+
+    return matrices, metrics_from_confusion(matrices)
+
+def prediction_colors(classes_pred, classes, positions, test_indices=None, colors=OUTCOME_COLORS):
+    '''Colors of the glands according to the prediction outcome of a single run, for visualization
+    (see data_analysis_func.color_objects()).
+
+    Parameters
+    ----------
+    classes_pred : numpy array
+        Predicted class of each gland, -1 for glands not tested
+    classes : numpy array
+        True class of each gland
+    positions : numpy array
+        [N,2] array with the (row, column) position of each gland (e.g. GlandGraph.centroids)
+    test_indices : list
+        Glands to color, in this order. They must have been tested. If None, all the tested glands
+        are used
+    colors : numpy array
+        [2,2,3] array with the color of each (true class, predicted class) outcome
+
+    Returns
+    -------
+    position : list
+        Position of each colored gland
+    class_colors : list
+        Color of each gland
+    '''
+
+    classes_pred = np.asarray(classes_pred)
+    classes = np.asarray(classes).astype(int)
+    if test_indices is None:
+        test_indices = np.flatnonzero((classes_pred == 0) | (classes_pred == 1))
+    test_indices = np.asarray(test_indices, dtype=int)
+
+    class_colors = np.asarray(colors)[classes[test_indices], classes_pred[test_indices]]
+    position = np.asarray(positions)[test_indices]
+
+    return position.tolist(), class_colors.tolist()
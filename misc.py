@@ -3,18 +3,28 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import networkx.drawing as draw
     
-def PCA(X, new_dim, use_cov=False):
+def PCA(X, new_dim, use_cov=False, mode='full', chunk_size=100000, num_iterations=4, oversampling=10, seed=None):
     """
     IN:
     X: [N,M] array, where N is the number of objects and M the number of features
     new_dim: Dimension of the projected data (number of PCA features)
     useCov: Whether to use covariance matrix (True) or correlation matrix (False)
+    mode: 'full' builds the covariance or correlation matrix from the whole X in memory
+          'streaming' accumulates the covariance matrix from chunks of `chunk_size` rows, so X
+          can be a memory-mapped array or a list of arrays (e.g. the tables of several slides)
+          'randomized' calculates only the first `new_dim` components by randomized subspace 
+          iteration, reading X by chunks and without building the [M,M] matrix
+    num_iterations, oversampling, seed: number of power iterations, number of additional vectors in 
+          the subspace and random seed of the 'randomized' mode
 
     OUT:
     PCA_features: [N,new_dim] array, new features
-    eigenvalues: Eigenvalues in decreasing order
+    eigenvalues: Eigenvalues in decreasing order (only the first new_dim in 'randomized' mode)
     main_eigenvectors: [N,new_dim] array, Eigenvectors in each column
     """
+
+    if mode != 'full':
+        return _PCA_chunked(X, new_dim, use_cov, mode, chunk_size, num_iterations, oversampling, seed)
     
     # Use covariance matrix or correlation matrix
     if use_cov:
@@ -49,17 +59,107 @@ def PCA(X, new_dim, use_cov=False):
     
     return PCA_features, eigenvalues, main_eigenvectors    
 
+def _PCA_chunked(X, new_dim, use_cov, mode, chunk_size, num_iterations, oversampling, seed):
+    """PCA() in the 'streaming' and 'randomized' modes."""
+
+    if mode not in ('streaming', 'randomized'):
+        raise ValueError(f"Unknown PCA mode '{mode}'")
+
+    def chunks():
+        if isinstance(X, (list, tuple)):
+            for X_chunk in X:
+                yield np.asarray(X_chunk, dtype=float)
+        else:
+            for start in range(0, len(X), chunk_size):
+                yield np.asarray(X[start:start+chunk_size], dtype=float)
+
+    # Mean and scatter matrix (or only its diagonal) merged chunk by chunk (Chan et al.)
+    full_scatter = mode == 'streaming'
+    n = 0
+    u = None
+    for X_chunk in chunks():
+        n_chunk = len(X_chunk)
+        if n_chunk == 0:
+            continue
+        u_chunk = X_chunk.mean(axis=0)
+        X_chunk = X_chunk - u_chunk
+        scatter_chunk = X_chunk.T @ X_chunk if full_scatter else np.sum(X_chunk**2, axis=0)
+        if u is None:
+            n, u, scatter = n_chunk, u_chunk, scatter_chunk
+            continue
+        delta = u_chunk - u
+        n_total = n + n_chunk
+        correction = np.outer(delta, delta) if full_scatter else delta**2
+        scatter = scatter + scatter_chunk + correction*n*n_chunk/n_total
+        u = u + delta*n_chunk/n_total
+        n = n_total
+
+    variance = (np.diag(scatter) if full_scatter else scatter)/(n-1)
+    stdev = np.sqrt(variance)
+    # Scale of each feature, the correlation matrix is the covariance of the standardized features
+    scale = np.ones_like(stdev) if use_cov else stdev
+
+    if full_scatter:
+        C = scatter/(n-1)/np.outer(scale, scale)
+        if not use_cov:
+            C = np.clip(C, -1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(C)
+        sorted_indices = np.argsort(eigenvalues)[::-1]
+        eigenvalues = eigenvalues[sorted_indices]
+        main_eigenvectors = eigenvectors[:,sorted_indices][:,0:new_dim]
+    else:
+        def C_dot(Q):
+            # Product of the covariance (or correlation) matrix and Q, calculated by chunks
+            result = np.zeros(Q.shape)
+            for X_chunk in chunks():
+                X_chunk = (X_chunk - u)/scale
+                result += X_chunk.T @ (X_chunk @ Q)
+            return result/(n-1)
+
+        num_features = len(u)
+        subspace_dim = min(new_dim + oversampling, num_features)
+        rng = np.random.default_rng(seed)
+        Q, _ = np.linalg.qr(rng.standard_normal((num_features, subspace_dim)))
+        for _ in range(num_iterations):
+            Q, _ = np.linalg.qr(C_dot(Q))
+        # Rayleigh-Ritz projection on the subspace
+        B = Q.T @ C_dot(Q)
+        eigenvalues, eigenvectors = np.linalg.eigh((B + B.T)/2)
+        sorted_indices = np.argsort(eigenvalues)[::-1][0:new_dim]
+        eigenvalues = eigenvalues[sorted_indices]
+        main_eigenvectors = Q @ eigenvectors[:,sorted_indices]
+
+    # Project the data into new variables (PCA features)
+    PCA_features = np.concatenate([((X_chunk - u)/scale) @ main_eigenvectors for X_chunk in chunks()])
+
+    return PCA_features, eigenvalues, main_eigenvectors
+
 def mask_correction(mask):
-    if (len(np.unique(mask)) > 2):
-        mask[mask < 128] = 0
-        mask[mask >= 128] = 255
-        mask = 255-mask
+    if (num_distinct_values(mask) > 2):
+        low = mask < 128
+        if mask.dtype == np.uint8:
+            # Same result as the general case below, without boolean indexing
+            inverted = low.view(np.uint8)*np.uint8(255)
+            np.subtract(np.uint8(255), inverted, out=mask)
+            mask = inverted
+        else:
+            mask[low] = 0
+            mask[~low] = 255
+            mask = 255-mask
     
-    if(len(np.unique(mask)) != 2):
+    if(num_distinct_values(mask) != 2):
         print('ERROR, CHECK IMAGE MASK')
     
     return mask
 
+def num_distinct_values(img):
+    '''Number of distinct values in `img`. For 8-bit images the values are counted with a histogram,
+    which is much faster than np.unique.'''
+
+    if img.dtype == np.uint8 or img.dtype == bool:
+        return np.count_nonzero(np.bincount(img.ravel().view(np.uint8), minlength=2))
+    return len(np.unique(img))
+
 def plot_graph(nxgraph, pos, weights, img_mask=None, min_width=1, max_width=10, title='', path_result=None, plt_figsize=(24,16), plt_node_size=10, alpha=.6, show_edges=True):
 
     pos = np.array(pos)
@@ -102,13 +202,23 @@ def igraph_to_nx(g):
     
     '''Create NetworkX Graph'''
 
+    nxgraph = edges_to_nx(g.get_edgelist(), g.vcount())
+        
+    return nxgraph
+
+def edges_to_nx(edges, num_nodes, weights=None):
+    '''Create NetworkX Graph with nodes 0 to `num_nodes`-1 from a list or [E,2] array of edges, 
+    adding all nodes and edges in bulk. If `weights` is given, it is stored in the 'weight' attribute
+    of the edges.'''
+
     nxgraph = nx.Graph()
-    for i in range(g.vcount()):
-        nxgraph.add_node(i)
+    nxgraph.add_nodes_from(range(num_nodes))
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    if weights is None:
+        nxgraph.add_edges_from(zip(edges[:,0].tolist(), edges[:,1].tolist()))
+    else:
+        nxgraph.add_weighted_edges_from(zip(edges[:,0].tolist(), edges[:,1].tolist(), np.asarray(weights).tolist()))
 
-    for edge in g.es:
-        nxgraph.add_edge(edge.source, edge.target)
-        
     return nxgraph
 
 def split_dataset(properties, classes, n_train, n_validate):
@@ -1,36 +1,176 @@
+import os
+import multiprocessing
 import numpy as np
-from skimage.measure import label, regionprops
+from skimage.measure import label, regionprops, regionprops_table
 from scipy.stats import zscore
 import networkx as nx
+from igraph import Graph
 import misc
+import geometric_graph
+from glands import extract_glands
+from gland_graph import GlandGraph
 
-def get_shape_props_from_mask(img_mask, props_to_measure, connectivity=1, return_scikit_props=False):
+def get_shape_props_from_mask(img_mask, props_to_measure, connectivity=1, return_scikit_props=False, glands=None):
     '''Return shape properties calculated for glands in image `img_mask`. `props_to_measure` is a list
-    of shape properties name to calculate.'''
+    of shape properties name to calculate. If `glands` (see glands.extract_glands()) is given, its label
+    image is used instead of labeling the mask again, and `connectivity` is ignored. The properties are
+    calculated in bulk by get_shape_props_table().'''
     
-    label_img, qtt = label(img_mask, return_num=True, connectivity=connectivity)
-    props = regionprops(label_img)
-    all_shape_props = []
-    for idx, prop in enumerate(props):
-        shape_prop = []
-        for prop_name in props_to_measure:
-            shape_prop.append(prop[prop_name])
-        all_shape_props.append(shape_prop)
-
-    all_shape_props = np.array(all_shape_props)
+    if glands is None:
+        label_img, qtt = label(img_mask, return_num=True, connectivity=connectivity)
+    else:
+        label_img = glands.label_img
+    all_shape_props = get_shape_props_table(label_img, props_to_measure)
     
     if return_scikit_props:
         # Also returns list from scikit-image containing RegionProperties objects
-        return all_shape_props, props
+        return all_shape_props, regionprops(label_img)
     else:
         return all_shape_props
 
-def get_graph_props(nxgraph):
-    '''Return graph properties calculated for a networkx graph. The graph must have an attribute called 'weight'. '''
+def get_shape_props_table(label_img, props_to_measure):
+    '''Return a [N,M] array with the M properties in `props_to_measure` for each of the N objects in 
+    `label_img`. Area, equivalent diameter, eccentricity and perimeter (4-neighborhood) are calculated for 
+    all objects at once from the label image, with the same definitions used by scikit-image. Other 
+    properties are calculated by skimage.measure.regionprops_table(), which computes only the requested 
+    ones.'''
+
+    num_objects = int(label_img.max()) if label_img.size > 0 else 0
+    bulk = _ShapeMoments(label_img, num_objects)
+
+    other_props = [name for name in props_to_measure if name not in _BULK_SHAPE_PROPS]
+    if len(other_props) > 0:
+        other_table = regionprops_table(label_img, properties=other_props)
+
+    columns = []
+    for name in props_to_measure:
+        if name in _BULK_SHAPE_PROPS:
+            columns.append(getattr(bulk, _BULK_SHAPE_PROPS[name])())
+        else:
+            # Properties with more than one value (e.g. 'centroid') span several columns
+            columns.extend(values for key, values in other_table.items() 
+                           if key == name or key.startswith(name+'-'))
+
+    all_shape_props = np.column_stack(columns) if len(columns) > 0 else np.zeros((num_objects, 0))
+
+    return all_shape_props
+
+class _ShapeMoments:
+    '''Shape properties of all objects of a label image calculated from per-label sums.'''
+
+    def __init__(self, label_img, num_objects):
+
+        self.label_img = label_img
+        self.num_objects = num_objects
+        self._area = None
+        self._labels = None
+
+    def _pixels(self):
+        if self._labels is None:
+            rows, cols = np.nonzero(self.label_img)
+            self._labels = self.label_img[rows, cols]
+            self._rows = rows
+            self._cols = cols
+        return self._labels, self._rows, self._cols
+
+    def area(self):
+        if self._area is None:
+            labels, _, _ = self._pixels()
+            self._area = np.bincount(labels, minlength=self.num_objects+1)[1:].astype(float)
+        return self._area
+
+    def equivalent_diameter(self):
+        return (4*self.area()/np.pi)**(1/2)
+
+    def eccentricity(self):
+        labels, rows, cols = self._pixels()
+        area = self.area()
+        length = self.num_objects+1
+        center_row = np.bincount(labels, rows, length)[1:]/area
+        center_col = np.bincount(labels, cols, length)[1:]/area
+        drows = rows - center_row[labels-1]
+        dcols = cols - center_col[labels-1]
+        mu20 = np.bincount(labels, drows*drows, length)[1:]
+        mu02 = np.bincount(labels, dcols*dcols, length)[1:]
+        mu11 = np.bincount(labels, drows*dcols, length)[1:]
+
+        # Eigenvalues of the inertia tensor [[mu02, -mu11], [-mu11, mu20]]/mu00
+        half_trace = (mu20 + mu02)/(2*area)
+        radius = np.sqrt(((mu02 - mu20)/(2*area))**2 + (mu11/area)**2)
+        l1 = np.clip(half_trace + radius, 0, None)
+        l2 = np.clip(half_trace - radius, 0, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eccentricity = np.where(l1 == 0, 0., np.sqrt(1 - l2/np.where(l1 == 0, 1, l1)))
+        return eccentricity
+
+    def perimeter(self):
+        # Same weights as skimage.measure.perimeter(neighborhood=4), but with the erosion and the 
+        # neighbor codes calculated separately for each label
+        label_pad = np.pad(self.label_img, 1, 'constant')
+        center = label_pad[1:-1, 1:-1]
+        height, width = center.shape
+        def shifted(drow, dcol):
+            return label_pad[1+drow:1+drow+height, 1+dcol:1+dcol+width]
+
+        cross = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        diagonal = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+        eroded = center > 0
+        for drow, dcol in cross:
+            eroded &= shifted(drow, dcol) == center
+        border = (center > 0) & ~eroded
+        border_pad = np.pad(border, 1, 'constant')
+        def border_neighbor(drow, dcol):
+            return border_pad[1+drow:1+drow+height, 1+dcol:1+dcol+width] & (shifted(drow, dcol) == center)
+
+        code = border.astype(np.uint8)
+        for drow, dcol in cross:
+            code += np.uint8(2)*border_neighbor(drow, dcol)
+        for drow, dcol in diagonal:
+            code += np.uint8(10)*border_neighbor(drow, dcol)
+
+        perimeter_weights = np.zeros(50, dtype=np.float64)
+        perimeter_weights[[5, 7, 15, 17, 25, 27]] = 1
+        perimeter_weights[[21, 33]] = np.sqrt(2)
+        perimeter_weights[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+        rows, cols = np.nonzero(border)
+        labels = center[rows, cols].astype(np.int64)
+        histogram = np.bincount(labels*50 + code[rows, cols], minlength=(self.num_objects+1)*50)
+        histogram = histogram.reshape(self.num_objects+1, 50)[1:]
+
+        return histogram @ perimeter_weights
+
+# Properties calculated by _ShapeMoments, and the corresponding method
+_BULK_SHAPE_PROPS = {'area':'area', 'equivalent_diameter':'equivalent_diameter', 
+                     'equivalent_diameter_area':'equivalent_diameter', 'eccentricity':'eccentricity', 
+                     'perimeter':'perimeter'}
+
+def iterate_radius_props(img_mask, radii, props_to_measure, connectivity=1):
+    '''Yield (radius, g, cm, shape_props) for every radius in `radii`. The mask is labeled once, the shape 
+    properties, which do not depend on the radius, are calculated once for the slide, and all the geometric 
+    graphs come from a single neighbour query (see geometric_graph.networks_from_mask()).'''
+
+    glands = extract_glands(img_mask, connectivity)
+    shape_props = get_shape_props_from_mask(img_mask, props_to_measure, glands=glands)
+    graphs, cm = geometric_graph.networks_from_mask(img_mask, radii, glands)
+    for radius, g in zip(radii, graphs):
+        yield radius, g, cm, shape_props
+
+def get_graph_props(nxgraph, processes=None, pivots=None, epsilon=None, seed=None, print_progress=False):
+    '''Return graph properties calculated for a networkx graph. The graph must have an attribute called 'weight'. 
+    The betweenness is calculated using `processes` cores (all available cores if None). It is exact by default. 
+    Setting `pivots` (number of sampled source nodes) or `epsilon` (target absolute error) gives an approximation 
+    that is reproducible for a fixed `seed` (see betweenness_centrality_parallel()). `nxgraph` can also be a 
+    gland_graph.GlandGraph, whose properties are calculated from its arrays (see get_graph_props_from_edges()).'''
     
+    if isinstance(nxgraph, GlandGraph):
+        edges, weights = nxgraph.edges()
+        return get_graph_props_from_edges(edges, weights, nxgraph.num_nodes, pivots=pivots, epsilon=epsilon, seed=seed)
+
     degree = dict( nxgraph.degree() )
     strength = dict( nxgraph.degree(weight='weight') )
-    betweenness = nx.betweenness_centrality(nxgraph, weight='weight')
+    betweenness = betweenness_centrality_parallel(nxgraph, weight='weight', processes=processes, pivots=pivots,
+                                                  epsilon=epsilon, seed=seed, print_progress=print_progress)
 
     all_node_props = []
     for idx in range(len(nxgraph)):
@@ -44,6 +184,192 @@ def get_graph_props(nxgraph):
     
     return all_node_props
 
+def get_graph_props_from_edges(edges, weights, num_nodes, pivots=None, epsilon=None, delta=0.1, seed=None):
+    '''Array version of get_graph_props() that does not use networkx. `edges` is an [E,2] array with
+    the nodes of each edge (e.g. np.array(g.get_edgelist()) for an igraph graph) and `weights` the weight
+    of each edge (e.g. the result of calculate_weight_array()). The degree and the strength are calculated
+    with np.bincount and the betweenness with igraph, using the weights as distances, as in 
+    get_graph_props(). `pivots`, `epsilon`, `delta` and `seed` set the approximation of the betweenness 
+    as in betweenness_centrality_parallel(), with the same sampled source nodes for the same `seed`.
+
+    Returns
+    -------
+    all_node_props : numpy array
+        [num_nodes,3] array with the degree, strength and betweenness of each node
+    '''
+
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    weights = np.asarray(weights, dtype=float)
+    n = num_nodes
+
+    degree = np.bincount(edges.ravel(), minlength=n).astype(float)
+    strength = np.bincount(edges.ravel(), np.repeat(weights, 2), minlength=n)
+
+    if pivots is not None and pivots < 1:
+        raise ValueError(f"The number of pivots must be at least 1, got {pivots}")
+    if pivots is None and epsilon is not None:
+        pivots = pivots_for_error(n, epsilon, delta)
+    if pivots is None or pivots >= n:
+        sources = None
+        num_sources = n
+    else:
+        rng = np.random.default_rng(seed)
+        sources = np.sort(rng.choice(n, pivots, replace=False)).tolist()
+        num_sources = len(sources)
+
+    g = Graph(n=n, edges=edges.tolist())
+    betweenness = np.array(g.betweenness(directed=False, weights=weights.tolist(), sources=sources), dtype=float)
+    # igraph counts each pair of nodes once, networkx normalization counts both directions
+    scale = _betweenness_scale(n, True, False)
+    if scale is not None:
+        betweenness *= 2*scale
+    if num_sources < n:
+        betweenness *= n/num_sources
+
+    all_node_props = np.column_stack((degree, strength, betweenness))
+
+    return all_node_props
+
+# Graph shared with the worker processes of betweenness_centrality_parallel()
+_worker_graph = None
+_worker_weight = None
+
+def _init_betweenness_worker(nxgraph, weight):
+
+    global _worker_graph, _worker_weight
+    _worker_graph = nxgraph
+    _worker_weight = weight
+
+def _betweenness_partial(sources):
+    '''Sum of the dependencies of all nodes for paths starting at `sources` (Brandes accumulation).'''
+
+    # For undirected graphs networkx halves the values when normalized=False, undo it here
+    partial = nx.betweenness_centrality_subset(_worker_graph, sources, list(_worker_graph), 
+                                               normalized=False, weight=_worker_weight)
+    if not _worker_graph.is_directed():
+        partial = {node:2*value for node, value in partial.items()}
+
+    return len(sources), partial
+
+def betweenness_centrality_parallel(nxgraph, weight='weight', normalized=True, processes=None, pivots=None,
+                                    epsilon=None, delta=0.1, seed=None, chunks_per_process=4, print_progress=False):
+    '''Betweenness centrality calculated in parallel. The source nodes are split into chunks that are 
+    processed by a pool of `processes` worker processes (all available cores if None), and the partial 
+    dependencies returned by each chunk are summed. By default all nodes are used as sources and the 
+    result is the same as nx.betweenness_centrality(nxgraph, normalized=normalized, weight=weight), apart 
+    from floating point rounding due to the different summation order.
+
+    If `pivots` or `epsilon` is set, only a random sample of source nodes (pivots) is used and the sum
+    is scaled by n/pivots, which gives an unbiased estimate of the exact values. The sample depends only
+    on `seed`, so a fixed seed gives the same result in every run.
+
+    Parameters
+    ----------
+    nxgraph : networkx graph
+        Graph to calculate the betweenness
+    weight : str
+        Edge attribute used as distance in the shortest paths. If None, all edges have distance 1
+    normalized : bool
+        Whether the values are normalized by the number of pairs of nodes, as in networkx
+    processes : int
+        Number of worker processes. If 1, the calculation is done in the current process
+    pivots : int
+        Number of source nodes sampled for the approximation. If None and `epsilon` is also None, the 
+        exact betweenness is calculated
+    epsilon : float
+        Target absolute error of the normalized betweenness, used to set the number of pivots when
+        `pivots` is None (see pivots_for_error())
+    delta : float
+        Probability that the error of some node is larger than `epsilon`
+    seed : int
+        Seed of the random generator used for sampling the pivots
+    chunks_per_process : int
+        Number of chunks of source nodes for each process. More chunks give a better load balance and
+        more frequent progress reports
+    print_progress : bool
+        Whether to print the number of source nodes already processed
+
+    Returns
+    -------
+    betweenness : dict
+        Betweenness of each node
+    '''
+
+    if processes is None:
+        processes = os.cpu_count()
+    nodes = list(nxgraph)
+    n = len(nodes)
+
+    if pivots is not None and pivots < 1:
+        raise ValueError(f"The number of pivots must be at least 1, got {pivots}")
+    if pivots is None and epsilon is not None:
+        pivots = pivots_for_error(n, epsilon, delta)
+    if pivots is None or pivots >= n:
+        sources = np.arange(n)
+    else:
+        rng = np.random.default_rng(seed)
+        sources = np.sort(rng.choice(n, pivots, replace=False))
+    num_sources = len(sources)
+
+    num_chunks = max(1, min(num_sources, processes*chunks_per_process))
+    chunks = [chunk.tolist() for chunk in np.array_split(sources, num_chunks)]
+    chunks = [[nodes[idx] for idx in chunk] for chunk in chunks]
+
+    betweenness = dict.fromkeys(nodes, 0.0)
+    num_processed = 0
+    def accumulate(results):
+        nonlocal num_processed
+        for chunk_size, partial in results:
+            for node, value in partial.items():
+                betweenness[node] += value
+            num_processed += chunk_size
+            if print_progress:
+                print(f'Betweenness: {num_processed}/{num_sources} source nodes processed')
+
+    if processes == 1 or n < 2:
+        _init_betweenness_worker(nxgraph, weight)
+        accumulate(map(_betweenness_partial, chunks))
+    else:
+        with multiprocessing.Pool(processes, _init_betweenness_worker, (nxgraph, weight)) as pool:
+            # imap keeps the chunk order, so the summation order does not change between runs
+            accumulate(pool.imap(_betweenness_partial, chunks))
+
+    scale = _betweenness_scale(n, normalized, nxgraph.is_directed())
+    if num_sources < n:
+        # Extrapolate the sampled sources to all the nodes
+        scale = (1 if scale is None else scale)*n/num_sources
+    if scale is not None:
+        for node in betweenness:
+            betweenness[node] *= scale
+
+    return betweenness
+
+def pivots_for_error(n, epsilon, delta=0.1):
+    '''Number of pivots needed for the sampled normalized betweenness of all `n` nodes to be within 
+    `epsilon` of the exact value with probability at least 1-`delta`. Each pivot contributes a value 
+    in [0, n/(n-1)] to the estimate, so the bound follows from Hoeffding's inequality together with 
+    the union bound over the nodes. The result is capped at `n`, in which case the exact value is 
+    calculated.'''
+
+    if n <= 2:
+        return n
+    value_range = n/(n-1)
+    pivots = int(np.ceil(value_range**2*np.log(2*n/delta)/(2*epsilon**2)))
+
+    return min(pivots, n)
+
+def _betweenness_scale(n, normalized, directed):
+    '''Rescaling applied by networkx to the summed dependencies.'''
+
+    if normalized:
+        if n <= 2:
+            return None
+        return 1/((n-1)*(n-2))
+    elif not directed:
+        return 0.5
+    else:
+        return None
+
     
 def display_shape_props(img_mask, props_to_measure, shape_label, connectivity=1):
     '''Show the gland corresponding to label `shape_label` and also some shape properties.'''
@@ -126,7 +452,28 @@ def calculate_weight_all(nxgraph, pos_nodes, att_nodes, alpha=0., att_idx=None,
     weight_dict : dict
         A dicitonary of the edge weights
     '''
-    
+
+    edges = list(nxgraph.edges)
+    weights = calculate_weight_array(np.array(edges, dtype=int).reshape(-1, 2), pos_nodes, att_nodes,
+                                     alpha=alpha, att_idx=att_idx, normalize_pos=normalize_pos,
+                                     normalize_att=normalize_att, pos_means=pos_means, pos_stds=pos_stds,
+                                     att_means=att_means, att_stds=att_stds)
+    weight_dict = dict(zip(edges, weights.tolist()))
+
+    return weight_dict
+
+def calculate_weight_array(edges, pos_nodes, att_nodes, alpha=0., att_idx=None, normalize_pos=True,
+                           normalize_att=True, pos_means=None, pos_stds=None, att_means=None, att_stds=None):
+    '''Calculate the weights of all edges in a single batched computation. `edges` is an [E,2] array
+    containing the indices of the two nodes of each edge (e.g. np.array(g.get_edgelist()) for an igraph
+    graph). The other parameters are the same as in calculate_weight_all().
+
+    Returns
+    -------
+    weights : numpy array
+        Array of length E containing the weight of each edge
+    '''
+
     pos_nodes = np.array(pos_nodes)
     att_nodes = np.array(att_nodes)
     if normalize_pos or pos_means is not None:
@@ -136,17 +483,19 @@ def calculate_weight_all(nxgraph, pos_nodes, att_nodes, alpha=0., att_idx=None,
     if att_idx is None:
         # Use all attributes
         att_idx = ...
-    
-    weight_dict = {}
-    for edge in nxgraph.edges:
-        node1 = edge[0]
-        node2 = edge[1]
-        pos_node1 = pos_nodes[node1]
-        pos_node2 = pos_nodes[node2]
-        att_node1 = att_nodes[node1, att_idx]
-        att_node2 = att_nodes[node2, att_idx]
-        
-        weight = calculate_weight(pos_node1, pos_node2, att_node1, att_node2, alpha)
-        weight_dict[edge] = weight
 
-    return weight_dict   
\ No newline at end of file
+    att_nodes = att_nodes[:, att_idx]
+    if att_nodes.ndim == 1:
+        att_nodes = att_nodes[:, None]
+
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    node1 = edges[:, 0]
+    node2 = edges[:, 1]
+
+    dist_pos2 = np.sum((pos_nodes[node1]-pos_nodes[node2])**2, axis=1)
+    dist_att2 = np.sum((att_nodes[node1]-att_nodes[node2])**2, axis=1)
+
+    dist2 = alpha*dist_pos2 + (1-alpha)*dist_att2
+    weights = np.exp(-np.sqrt(dist2))
+
+    return weights
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+from skimage import io
+import misc
+import prop
+import geometric_graph
+from glands import extract_glands
+
+# Content-addressed cache of the stages of the gland graph pipeline (mask reading and correction,
+# labeling, shape properties, geometric graph, edge weights and graph properties). The key of a
+# stage is the hash of its name, its parameters and the keys of its inputs, and the key of the
+# first stage is the hash of the bytes of the image file. So a stage is computed again only when
+# the image or some parameter it depends on changes. The results are pickled in a directory on the
+# local disk, and the least recently used ones are removed when the directory exceeds a given size.
+
+def hash_file(filename, chunk_size=2**20):
+    '''Return the sha256 hash of the contents of a file.'''
+
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def hash_array(array):
+    '''Return the sha256 hash of a numpy array, including its dtype and shape.'''
+
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha256()
+    sha.update(f'{array.dtype.str}{array.shape}'.encode())
+    sha.update(array.data)
+
+    return sha.hexdigest()
+
+def stage_key(stage, inputs=(), **params):
+    '''Return the key of a stage given its name, the keys of its inputs (hashes of files or
+    arrays, or keys of previous stages) and its parameters.'''
+
+    description = json.dumps([stage, list(inputs), params], sort_keys=True, default=str)
+
+    return hashlib.sha256(description.encode()).hexdigest()
+
+class StageCache:
+    '''Cache of pipeline stages stored in directory `path`. When the total size of the cached
+    results exceeds `max_size` bytes, the least recently used results are removed.'''
+
+    def __init__(self, path='.stage_cache', max_size=2*1024**3):
+
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+
+        return os.path.join(self.path, f'{key}.pkl')
+
+    def __contains__(self, key):
+
+        return os.path.exists(self._filename(key))
+
+    def get(self, key):
+        '''Return the result stored for `key`, or raise KeyError if it is not in the cache.'''
+
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+        # The modification time is used as the time of last access
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            # Evicted by another process after being read
+            pass
+
+        return value
+
+    def put(self, key, value):
+        '''Store `value` for `key` and remove old results if the cache became too large.'''
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Atomic, so an interrupted write never leaves a corrupted result
+        os.replace(tmp_filename, self._filename(key))
+        self.evict()
+
+    def cached(self, key, func):
+        '''Return the result stored for `key`. If it is not in the cache, it is calculated by
+        calling `func()` and stored.'''
+
+        try:
+            return self.get(key)
+        except KeyError:
+            value = func()
+            self.put(key, value)
+            return value
+
+    def evict(self):
+        '''Remove the least recently used results until the cache size is at most `max_size`.'''
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(filename)
+            total_size -= size
+
+    def clear(self):
+        '''Remove all the cached results.'''
+
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+def gland_graph_pipeline(path_mask, path_expert_demarcation, radius, shape_props_to_measure, connectivity=1,
+                         alpha=0., att_idx=0, cache=None):
+    '''Run the pipeline of AppGenerateMultipleGeometricGraphRadius for a slide, computing only the
+    stages whose inputs are not already in `cache`. Stages whose results are cached are not even
+    loaded when no later stage needs them.
+
+    Parameters
+    ----------
+    path_mask : str
+        Path of the glands mask
+    path_expert_demarcation : str
+        Path of the mask of the area demarcated by the expert
+    radius : float
+        Radius of the geometric graph
+    shape_props_to_measure : list
+        Shape properties of the glands (see prop.get_shape_props_from_mask())
+    connectivity : int
+        Connectivity used for labeling the glands
+    alpha : float
+        Relative importance of positions and attributes in the edge weights (see prop.calculate_weight())
+    att_idx : int
+        Index of the shape property used in the edge weights. If None, all properties are used
+    cache : StageCache
+        Cache of the stages. If None, a cache in the default directory is used
+
+    Returns
+    -------
+    results : dict
+        Dictionary with the keys 'cm' (positions of the nodes), 'edges' ([E,2] array), 'shape_props',
+        'weights' (weight of each edge), 'net_props' (degree, strength and betweenness of each node, see
+        prop.get_graph_props()) and 'demarcated' (whether the centroid of each gland is in the expert
+        demarcation)
+    '''
+
+    if cache is None:
+        cache = StageCache()
+    shape_props_to_measure = list(shape_props_to_measure)
+
+    mask_key = stage_key('mask', [hash_file(path_mask)])
+    demarcation_key = stage_key('mask', [hash_file(path_expert_demarcation)])
+    glands_key = stage_key('glands', [mask_key], connectivity=connectivity)
+    shape_key = stage_key('shape_props', [glands_key], props=shape_props_to_measure)
+    graph_key = stage_key('geometric_graph', [mask_key, glands_key], radius=radius)
+    weights_key = stage_key('weights', [graph_key, shape_key], alpha=alpha, att_idx=att_idx)
+    net_props_key = stage_key('graph_props', [graph_key, weights_key])
+    demarcated_key = stage_key('demarcated', [glands_key, demarcation_key])
+
+    def mask():
+        return cache.cached(mask_key, lambda: misc.mask_correction(io.imread(path_mask)))
+
+    def expert_demarcation():
+        return cache.cached(demarcation_key, lambda: misc.mask_correction(io.imread(path_expert_demarcation)))
+
+    def glands():
+        return cache.cached(glands_key, lambda: extract_glands(mask(), connectivity))
+
+    def shape_props():
+        return cache.cached(shape_key, lambda: prop.get_shape_props_from_mask(mask(), shape_props_to_measure,
+                                                                              glands=glands()))
+
+    def graph():
+        def calculate():
+            g, cm = geometric_graph.network_from_mask(mask(), radius, glands())
+            return np.array(g.get_edgelist(), dtype=int).reshape(-1, 2), cm
+        return cache.cached(graph_key, calculate)
+
+    def weights():
+        def calculate():
+            edges, cm = graph()
+            return prop.calculate_weight_array(edges, cm, shape_props(), alpha=alpha, att_idx=att_idx)
+        return cache.cached(weights_key, calculate)
+
+    def net_props():
+        def calculate():
+            edges, cm = graph()
+            return prop.get_graph_props_from_edges(edges, weights(), len(cm))
+        return cache.cached(net_props_key, calculate)
+
+    def demarcated():
+        def calculate():
+            centroids = glands().centroids.astype(int)
+            return expert_demarcation()[centroids[:,0], centroids[:,1]] == 255
+        return cache.cached(demarcated_key, calculate)
+
+    edges, cm = graph()
+    results = {
+        'cm': cm,
+        'edges': edges,
+        'shape_props': shape_props(),
+        'weights': weights(),
+        'net_props': net_props(),
+        'demarcated': demarcated()
+    }
+
+    return results
@@ -0,0 +1,237 @@
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import regionprops
+import geometric_graph
+
+# Out-of-core versions of the mask processing functions. The mask is read tile by tile from an
+# array-like object, usually a memory-mapped .npy file, so the peak memory is set by the tile size
+# and not by the size of the slide. Glands crossing tile borders are stitched by comparing the labels
+# on both sides of each seam, and the shape properties of each gland are measured on a window read
+# around its bounding box. The results are the same as the ones of the in-memory functions.
+
+def open_mask(img_mask, mode='r'):
+    '''Return `img_mask` as an array. If `img_mask` is the path of a .npy file, it is memory-mapped.'''
+
+    if isinstance(img_mask, str):
+        return np.load(img_mask, mmap_mode=mode)
+    return img_mask
+
+def iter_tiles(shape, tile_shape):
+    '''Iterate over the tiles of an image with the given `shape` in raster order. Yields the
+    (first_row, last_row+1, first_col, last_col+1) bounds of each tile.'''
+
+    for r0 in range(0, shape[0], tile_shape[0]):
+        for c0 in range(0, shape[1], tile_shape[1]):
+            yield r0, min(r0+tile_shape[0], shape[0]), c0, min(c0+tile_shape[1], shape[1])
+
+def mask_correction_tiled(img_mask, out=None, tile_shape=(4096, 4096)):
+    '''Tiled version of misc.mask_correction(). The corrected mask is written to `out`, or to
+    `img_mask` itself (which must then be writable) if `out` is None.'''
+
+    img_mask = open_mask(img_mask, 'r+')
+    if out is None:
+        out = img_mask
+
+    def distinct_values(max_values):
+        values = set()
+        for r0, r1, c0, c1 in iter_tiles(img_mask.shape, tile_shape):
+            values.update(np.unique(out[r0:r1, c0:c1]).tolist())
+            if len(values) > max_values:
+                break
+        return values
+
+    values = set()
+    for r0, r1, c0, c1 in iter_tiles(img_mask.shape, tile_shape):
+        values.update(np.unique(img_mask[r0:r1, c0:c1]).tolist())
+        if len(values) > 2:
+            break
+
+    if len(values) > 2:
+        for r0, r1, c0, c1 in iter_tiles(img_mask.shape, tile_shape):
+            tile = np.array(img_mask[r0:r1, c0:c1])
+            tile_out = np.zeros_like(tile)
+            tile_out[tile < 128] = 255
+            out[r0:r1, c0:c1] = tile_out
+    elif out is not img_mask:
+        for r0, r1, c0, c1 in iter_tiles(img_mask.shape, tile_shape):
+            out[r0:r1, c0:c1] = img_mask[r0:r1, c0:c1]
+
+    if len(distinct_values(2)) != 2:
+        print('ERROR, CHECK IMAGE MASK')
+
+    return out
+
+def label_tiled(img_mask, connectivity=1, tile_shape=(4096, 4096)):
+    '''Find the connected components of `img_mask` tile by tile. Components are numbered in the
+    order of their first pixel in raster order, as in ndi.label and skimage.measure.label.
+
+    Returns
+    -------
+    glands : dict
+        Dictionary with the arrays (one element per gland) 'area', 'centroid' (center of mass
+        weighted by the mask values, as in ndi.center_of_mass, in (row, col) order), 'bbox'
+        (min_row, min_col, max_row+1, max_col+1) and 'first_pixel' (row, col)
+    '''
+
+    img_mask = open_mask(img_mask)
+    height, width = img_mask.shape
+    structure = ndi.generate_binary_structure(2, connectivity)
+
+    tile_rows = range(0, height, tile_shape[0])
+    tile_cols = range(0, width, tile_shape[1])
+    # Labels along the seams between tiles
+    seam_bottom = np.zeros((len(tile_rows), width), dtype=np.int64)
+    seam_top = np.zeros((len(tile_rows), width), dtype=np.int64)
+    seam_right = np.zeros((len(tile_cols), height), dtype=np.int64)
+    seam_left = np.zeros((len(tile_cols), height), dtype=np.int64)
+
+    stats = {'area':[], 'mass':[], 'sum_row':[], 'sum_col':[], 'first':[], 'min_row':[], 'min_col':[],
+             'max_row':[], 'max_col':[]}
+    num_labels = 0
+    for r0, r1, c0, c1 in iter_tiles(img_mask.shape, tile_shape):
+        tile = np.asarray(img_mask[r0:r1, c0:c1])
+        tile_label, num = ndi.label(tile, structure)
+        if num > 0:
+            _tile_stats(tile, tile_label, num, r0, c0, width, stats)
+        global_label = np.where(tile_label > 0, tile_label + num_labels, 0)
+        num_labels += num
+
+        tile_row, tile_col = r0//tile_shape[0], c0//tile_shape[1]
+        seam_top[tile_row, c0:c1] = global_label[0]
+        seam_bottom[tile_row, c0:c1] = global_label[-1]
+        seam_left[tile_col, r0:r1] = global_label[:,0]
+        seam_right[tile_col, r0:r1] = global_label[:,-1]
+
+    stats = {key:np.concatenate(value) if len(value) > 0 else np.zeros(0) for key, value in stats.items()}
+
+    # Join the labels touching across each seam
+    pairs = []
+    for idx in range(1, len(tile_rows)):
+        pairs.extend(_seam_pairs(seam_bottom[idx-1], seam_top[idx], connectivity))
+    for idx in range(1, len(tile_cols)):
+        pairs.extend(_seam_pairs(seam_right[idx-1], seam_left[idx], connectivity))
+    if len(pairs) > 0:
+        pairs = np.concatenate(pairs, axis=0) - 1
+    else:
+        pairs = np.zeros((0, 2), dtype=np.int64)
+    adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(num_labels, num_labels))
+    num_glands, component = connected_components(adjacency, directed=False)
+
+    def reduce(values, ufunc, initial):
+        result = np.full(num_glands, initial, dtype=values.dtype)
+        ufunc.at(result, component, values)
+        return result
+
+    first = reduce(stats['first'], np.minimum, np.iinfo(np.int64).max)
+    order = np.argsort(first)
+    rank = np.empty(num_glands, dtype=np.int64)
+    rank[order] = np.arange(num_glands)
+    component = rank[component]
+    first = first[order]
+
+    mass = np.bincount(component, stats['mass'], num_glands)
+    glands = {
+        'area': np.bincount(component, stats['area'], num_glands).astype(np.int64),
+        'centroid': np.column_stack((np.bincount(component, stats['sum_row'], num_glands)/mass,
+                                     np.bincount(component, stats['sum_col'], num_glands)/mass)),
+        'bbox': np.column_stack((reduce(stats['min_row'], np.minimum, height),
+                                 reduce(stats['min_col'], np.minimum, width),
+                                 reduce(stats['max_row'], np.maximum, 0),
+                                 reduce(stats['max_col'], np.maximum, 0))),
+        'first_pixel': np.column_stack((first//width, first%width))
+    }
+
+    return glands
+
+def _tile_stats(tile, tile_label, num, r0, c0, width, stats):
+    '''Append the statistics of the components of a tile to `stats`.'''
+
+    flat_label = tile_label.ravel()
+    values = tile.ravel().astype(float)
+    rows, cols = np.indices(tile.shape)
+    rows = rows.ravel() + r0
+    cols = cols.ravel() + c0
+
+    stats['area'].append(np.bincount(flat_label, minlength=num+1)[1:])
+    stats['mass'].append(np.bincount(flat_label, values, num+1)[1:])
+    stats['sum_row'].append(np.bincount(flat_label, values*rows, num+1)[1:])
+    stats['sum_col'].append(np.bincount(flat_label, values*cols, num+1)[1:])
+
+    _, first_idx = np.unique(flat_label, return_index=True)
+    first_idx = first_idx[-num:]
+    stats['first'].append(rows[first_idx]*width + cols[first_idx])
+
+    slices = ndi.find_objects(tile_label, num)
+    stats['min_row'].append(np.array([s[0].start for s in slices]) + r0)
+    stats['max_row'].append(np.array([s[0].stop for s in slices]) + r0)
+    stats['min_col'].append(np.array([s[1].start for s in slices]) + c0)
+    stats['max_col'].append(np.array([s[1].stop for s in slices]) + c0)
+
+def _seam_pairs(labels_before, labels_after, connectivity):
+    '''Pairs of labels touching across a seam. `labels_before` and `labels_after` are the labels
+    of the two lines of pixels on each side of the seam.'''
+
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    pairs = []
+    for shift in shifts:
+        if shift < 0:
+            before, after = labels_before[-shift:], labels_after[:shift]
+        elif shift > 0:
+            before, after = labels_before[:-shift], labels_after[shift:]
+        else:
+            before, after = labels_before, labels_after
+        touching = (before > 0) & (after > 0)
+        pairs.append(np.column_stack((before[touching], after[touching])))
+
+    return pairs
+
+def centers_of_mass_tiled(img_mask, tile_shape=(4096, 4096), glands=None):
+    '''Tiled version of geometric_graph.centers_of_mass(). `glands` is the result of label_tiled(),
+    which is computed if not given.'''
+
+    img_mask = open_mask(img_mask)
+    if glands is None:
+        glands = label_tiled(img_mask, connectivity=1, tile_shape=tile_shape)
+
+    #ROTATE CENTER OF MASS
+    cm = glands['centroid'][:,::-1].copy()
+    cm[:,1] = img_mask.shape[0]-cm[:,1]
+
+    return cm
+
+def network_from_mask_tiled(img_mask, radius, tile_shape=(4096, 4096), glands=None):
+    '''Tiled version of geometric_graph.network_from_mask().'''
+
+    cm = centers_of_mass_tiled(img_mask, tile_shape, glands)
+    g = geometric_graph.geometric_graph(cm, radius)
+
+    return g, cm
+
+def get_shape_props_from_mask_tiled(img_mask, props_to_measure, connectivity=1, tile_shape=(4096, 4096), 
+                                    glands=None):
+    '''Tiled version of prop.get_shape_props_from_mask(). Each gland is measured on the window of
+    `img_mask` given by its bounding box, so the memory needed is set by the tile size and by the
+    size of the largest gland. `glands` is the result of label_tiled(), which is computed if not given,
+    so a single labeling pass can be shared with network_from_mask_tiled().'''
+
+    img_mask = open_mask(img_mask)
+    if glands is None:
+        glands = label_tiled(img_mask, connectivity=connectivity, tile_shape=tile_shape)
+    structure = ndi.generate_binary_structure(2, connectivity)
+
+    all_shape_props = []
+    for (min_row, min_col, max_row, max_col), (row, col) in zip(glands['bbox'], glands['first_pixel']):
+        window = np.asarray(img_mask[min_row:max_row, min_col:max_col])
+        window_label, _ = ndi.label(window, structure)
+        gland_img = (window_label == window_label[row-min_row, col-min_col]).astype(np.uint8)
+        prop = regionprops(gland_img, offset=(min_row, min_col))[0]
+        shape_prop = []
+        for prop_name in props_to_measure:
+            shape_prop.append(prop[prop_name])
+        all_shape_props.append(shape_prop)
+
+    all_shape_props = np.array(all_shape_props)
+
+    return all_shape_props
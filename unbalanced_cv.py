@@ -1,4 +1,5 @@
 import numpy as np
+from sklearn.neighbors import NearestNeighbors
 
 # Only works for two classes
 
@@ -73,6 +74,58 @@ def get_splits(Ns, Nl, folds):
         
     return splits
 
+def get_fold_index_arrays(classes, num_folds, num_real=1):
+    '''Return the train and test indices of the folds of `num_real` realizations of the unbalanced 
+    cross-validation, without copying any data. The folds are the same yielded by get_fold() for the 
+    same random state, so `data[train_idx]` and `classes[train_idx]` give `data_train` and 
+    `classes_train`, and likewise for the test data.
+
+    Parameters
+    ----------
+    classes : numpy array
+        Array containing the class (0 or 1) of each object
+    num_folds : int
+        Number of folds for cross-validation
+    num_real : int
+        Number of realizations, each one with a new random permutation of the objects
+    Returns
+    -------
+    realizations : list
+        List with one element per realization. Each element is a list containing, for each fold, a 
+        tuple (train_idx, test_idx) of index arrays. As in get_fold(), objects from the smaller class 
+        come first in both arrays.
+    '''
+
+    classes = np.array(classes)
+
+    num_elem_in_class = np.bincount(classes)
+    smaller_class = np.argmin(num_elem_in_class)
+
+    inds_smaller = np.nonzero(classes==smaller_class)[0]
+    inds_larger = np.nonzero(classes==1-smaller_class)[0]
+
+    Ns = len(inds_smaller)
+    Nl = len(inds_larger)
+
+    realizations = []
+    for real in range(num_real):
+        splits = get_splits(Ns, Nl, num_folds)
+
+        perm_inds_smaller = inds_smaller[np.random.permutation(Ns)]
+        perm_inds_larger = inds_larger[np.random.permutation(Nl)]
+
+        folds = []
+        for split in splits:
+            inds_smaller_train, inds_larger_train, inds_smaller_test, inds_larger_test = split
+            train_idx = np.concatenate((perm_inds_smaller[inds_smaller_train], 
+                                        perm_inds_larger[inds_larger_train])).astype(int)
+            test_idx = np.concatenate((perm_inds_smaller[inds_smaller_test], 
+                                       perm_inds_larger[inds_larger_test])).astype(int)
+            folds.append((train_idx, test_idx))
+        realizations.append(folds)
+
+    return realizations
+
 def get_fold(data, classes, num_folds):
     '''Yields the folds of an unbalanced cross-validation.
     
@@ -100,42 +153,70 @@ def get_fold(data, classes, num_folds):
         Indices of the test data in matrix `data`
     '''
     
-    data = np.array(data)
+    data = np.asarray(data)
     classes = np.array(classes)
 
-    num_elem_in_class = np.bincount(classes)
-    smaller_class = np.argmin(num_elem_in_class)
-    larger_class = 1 - smaller_class
-
-    inds_smaller = np.nonzero(classes==smaller_class)[0]
-    inds_larger = np.nonzero(classes==1-smaller_class)[0]
-
-    Ns = len(inds_smaller)
-    Nl = len(inds_larger)
-
-    splits = get_splits(Ns, Nl, num_folds)
-
-    data_smaller = data[inds_smaller]
-    data_larger = data[inds_larger]
-
-    perm_smaller = np.random.permutation(Ns)
-    perm_larger = np.random.permutation(Nl)
-    data_smaller = data_smaller[perm_smaller]
-    data_larger = data_larger[perm_larger]
-
-    for split in splits:
+    folds = get_fold_index_arrays(classes, num_folds)[0]
+    for train_idx, test_idx in folds:
+        yield (data[train_idx], classes[train_idx].astype(int), data[test_idx], classes[test_idx].astype(int), 
+               test_idx.tolist())
 
-        inds_smaller_train, inds_larger_train, inds_smaller_test, inds_larger_test = split
-        data_train = np.concatenate((data_smaller[inds_smaller_train], data_larger[inds_larger_train]), axis=0)
-        classes_train = np.concatenate(([smaller_class]*len(inds_smaller_train), 
-                                        [larger_class]*len(inds_larger_train)))
+def knn_k_sweep(data, classes, num_folds, ks, folds=None):
+    '''Predict the classes of the unbalanced cross-validation using a k-nearest neighbors classifier 
+    for every k in `ks`. The neighbors of the test objects are searched only once per fold, for the 
+    largest k, and the prediction for each k is the majority vote among the first k neighbors. The 
+    predictions are the same as training a KNeighborsClassifier(n_neighbors=k) for each k (ties in 
+    the vote go to the lower class label, as in scikit-learn), except when several training objects are 
+    at the same distance from a test object. In this case the neighbors kept among the tied objects 
+    are arbitrary in both approaches and may be different.
 
-        data_test = np.concatenate((data_smaller[inds_smaller_test], data_larger[inds_larger_test]), axis=0)
-        classes_test = np.concatenate(([smaller_class]*len(inds_smaller_test), 
-                                        [larger_class]*len(inds_larger_test)))
+    Parameters
+    ----------
+    data : numpy array
+        Data matrix where each column represents a feature and each row an object.
+    classes : numpy array
+        Array containing the classes for each row of `data`.
+    num_folds : int
+        Number of folds for cross-validation
+    ks : list
+        Numbers of neighbors to evaluate
+    folds : list
+        List of (train_idx, test_idx) tuples, as returned by get_fold_index_arrays() for one 
+        realization. If None, the folds of a new realization are drawn.
+    Returns
+    -------
+    classes_pred : numpy array
+        [len(ks),N] array with the predicted class of each object for each k. Objects that were not
+        tested have class -1
+    indices_test : list
+        Indices of the tested objects, in the order of the folds
+    '''
 
-        or_ind_smaller = inds_smaller[perm_smaller[inds_smaller_test]].tolist()
-        or_ind_larger = inds_larger[perm_larger[inds_larger_test]].tolist()
-        indices_test = or_ind_smaller+or_ind_larger
-        
-        yield data_train, classes_train, data_test, classes_test, indices_test
\ No newline at end of file
+    data = np.asarray(data)
+    classes = np.array(classes).astype(int)
+    ks = np.array(ks, dtype=int)
+    if folds is None:
+        folds = get_fold_index_arrays(classes, num_folds)[0]
+
+    classes_pred = np.full((len(ks), len(classes)), -1)
+    indices_test = []
+    for train_idx, test_idx in folds:
+        classes_train = classes[train_idx]
+        labels, classes_train_enc = np.unique(classes_train, return_inverse=True)
+        max_k = min(ks.max(), len(train_idx))
+
+        nn = NearestNeighbors(n_neighbors=max_k).fit(data[train_idx])
+        neighbors = nn.kneighbors(data[test_idx], return_distance=False)
+
+        # Votes of the first k neighbors for each class, for all k at once
+        votes = np.zeros((len(test_idx), max_k, len(labels)), dtype=np.int32)
+        votes[np.arange(len(test_idx))[:,None], np.arange(max_k)[None,:], classes_train_enc[neighbors]] = 1
+        votes = np.cumsum(votes, axis=1)
+
+        for k_idx, k in enumerate(ks):
+            if k > len(train_idx):
+                raise ValueError(f'k={k} is larger than the number of training objects ({len(train_idx)})')
+            classes_pred[k_idx, test_idx] = labels[np.argmax(votes[:,k-1], axis=1)]
+        indices_test.extend(test_idx.tolist())
+
+    return classes_pred, indices_test
@@ -1,12 +1,14 @@
+import itertools
 import numpy as np
 import Polygon
-from scipy.spatial import Voronoi
+from scipy.spatial import Voronoi, Delaunay
 from igraph import Graph
 import matplotlib.pyplot as plt
 from matplotlib.collections import PolyCollection
 import networkx as nx
 import networkx.drawing as draw
-from scipy import ndimage
+import geometric_graph
+from feature_store import edges_to_csr
 
 def voronoi_network(points=None, N=None, allowedRegion=None):
     """Generate Voronoi network
@@ -28,6 +30,29 @@ def voronoi_network(points=None, N=None, allowedRegion=None):
     else:
         N = len(points)
 
+    temporaryPoints, allowedRegion = _padded_points(points, allowedRegion)
+
+    vor = Voronoi(temporaryPoints)
+
+    rectangle = _region_rectangle(allowedRegion)
+    if rectangle is None:
+        cellCollection, isBorder, edges = _clip_voronoi_polygon(vor, allowedRegion)
+    else:
+        cellCollection, isBorder, edges = _clip_voronoi_rectangle(vor, rectangle)
+
+    # Remove edges to the additional points
+    edges = edges[np.all(edges<N, axis=1)]
+    g = Graph(n=N, edges=edges.tolist())
+
+    g.vs['isBorder'] = isBorder
+    g.vs['pos'] = points.tolist()
+
+    return g, cellCollection
+
+def _padded_points(points, allowedRegion=None):
+    """Return `points` plus four additional points far from them, which make all the cells of
+    `points` finite, and the allowed region (the bounding box of the points if None)."""
+
     xmin, ymin = np.min(points, axis=0)
     xmax, ymax = np.max(points, axis=0)
 
@@ -35,16 +60,97 @@ def voronoi_network(points=None, N=None, allowedRegion=None):
         allowedRegion = np.array([(xmin, ymin), (xmax, ymin), 
                                   (xmax, ymax), (xmin, ymax)])
 
-
-    regionPol = Polygon.Polygon(allowedRegion)
-
     scale = np.maximum(xmax-xmin, ymax-ymin)
     additionalPoints = [(xmin-scale, ymin-scale),(xmax+scale, ymin-scale),
                         (xmax+scale, ymax+scale),(xmin-scale, ymax+scale)]
 
-    temporaryPoints = np.array(points.tolist() + additionalPoints)
+    temporaryPoints = np.vstack((points, additionalPoints))
 
-    vor = Voronoi(temporaryPoints)
+    return temporaryPoints, allowedRegion
+
+def _region_rectangle(allowedRegion):
+    """Return (xmin, ymin, xmax, ymax) if `allowedRegion` is an axis-aligned rectangle, or None 
+    otherwise."""
+
+    region = np.asarray(allowedRegion, dtype=float)
+    if region.shape != (4, 2):
+        return None
+    xs = np.unique(region[:,0])
+    ys = np.unique(region[:,1])
+    if len(xs) != 2 or len(ys) != 2:
+        return None
+    corners = set(map(tuple, region.tolist()))
+    if corners != {(xs[0], ys[0]), (xs[1], ys[0]), (xs[1], ys[1]), (xs[0], ys[1])}:
+        return None
+    # Consecutive corners must share one coordinate, otherwise the contour crosses itself
+    nextRegion = np.roll(region, -1, axis=0)
+    if not np.all((region[:,0]==nextRegion[:,0]) | (region[:,1]==nextRegion[:,1])):
+        return None
+
+    return xs[0], ys[0], xs[1], ys[1]
+
+def _clip_voronoi_rectangle(vor, rectangle):
+    """Clip the cells of `vor` to an axis-aligned rectangle and remove the ridges with no vertex inside 
+    it, using array operations. Only the cells crossing the border of the rectangle need clipping.
+    Returns the clipped cells, the border flag of each cell and the remaining ridges."""
+
+    xmin, ymin, xmax, ymax = rectangle
+    vertices = vor.vertices
+    vertexInside = ((vertices[:,0]>=xmin) & (vertices[:,0]<=xmax) & 
+                    (vertices[:,1]>=ymin) & (vertices[:,1]<=ymax))
+
+    # Finite cells, in the order of the points
+    regions = [vor.regions[point] for point in vor.point_region]
+    regions = [region for region in regions if len(region)>0 and -1 not in region]
+    lengths = np.fromiter(map(len, regions), dtype=int, count=len(regions))
+    ends = np.cumsum(lengths)
+    regionVertices = np.fromiter(itertools.chain.from_iterable(regions), dtype=int, count=ends[-1])
+    isBorder = np.logical_not(np.logical_and.reduceat(vertexInside[regionVertices], ends-lengths)).astype(int)
+
+    cellCollection = np.split(vertices[regionVertices], ends[:-1])
+    for cellIndex in np.flatnonzero(isBorder):
+        cellCollection[cellIndex] = _clip_convex_rectangle(cellCollection[cellIndex], rectangle)
+
+    ridgeVertices = np.array(vor.ridge_vertices)
+    ridgeInside = (ridgeVertices>=0) & vertexInside[ridgeVertices]
+    edges = vor.ridge_points[np.any(ridgeInside, axis=1)]
+
+    return cellCollection, isBorder.tolist(), edges
+
+def _clip_convex_rectangle(cell, rectangle):
+    """Clip a convex polygon to an axis-aligned rectangle (Sutherland-Hodgman algorithm)."""
+
+    xmin, ymin, xmax, ymax = rectangle
+    # Each boundary is given by the coordinate, the limit and the side that is kept
+    for axis, limit, sign in [(0, xmin, 1), (0, xmax, -1), (1, ymin, 1), (1, ymax, -1)]:
+        dist = sign*(cell[:,axis]-limit)
+        inside = dist >= 0
+        if np.all(inside):
+            continue
+        nextCell = np.roll(cell, -1, axis=0)
+        nextDist = np.roll(dist, -1)
+        crosses = (dist >= 0) != (nextDist >= 0)
+
+        t = dist[crosses]/(dist[crosses]-nextDist[crosses])
+        intersections = cell[crosses] + t[:,None]*(nextCell[crosses]-cell[crosses])
+        intersections[:,axis] = limit
+
+        # For each vertex, keep it if inside and add the intersection of the following side
+        numNew = inside.astype(int) + crosses
+        newCell = np.empty((numNew.sum(), 2))
+        positions = np.cumsum(numNew) - numNew
+        newCell[positions[inside]] = cell[inside]
+        newCell[positions[crosses] + inside[crosses]] = intersections
+        cell = newCell
+
+    return cell
+
+def _clip_voronoi_polygon(vor, allowedRegion):
+    """Clip the cells of `vor` to a general polygon using the Polygon package and remove the ridges 
+    with no vertex inside it. Returns the clipped cells, the border flag of each cell and the remaining 
+    ridges."""
+
+    regionPol = Polygon.Polygon(allowedRegion)
 
     cellCollection = []
     isBorder = []
@@ -65,11 +171,8 @@ def voronoi_network(points=None, N=None, allowedRegion=None):
                 else:
                     isBorder.append(0)
 
-
-    edges = vor.ridge_points
-
     # Remove edges of neighbooring cells outside desired region
-    edges2remove = []
+    keepEdge = []
     for edgeIndex, vertices in enumerate(vor.ridge_vertices):
         shouldRemove = True
         if vertices[0]>=0:
@@ -81,18 +184,11 @@ def voronoi_network(points=None, N=None, allowedRegion=None):
             if regionPol.isInside(v[0], v[1])==True:
                 shouldRemove = False
 
-        if shouldRemove==True:
-            edges2remove.append(edgeIndex)
+        keepEdge.append(not shouldRemove)
 
-    g = Graph(edges=edges.tolist())
-    g.delete_edges(edges2remove)
-    tempPointsIndices = range(len(points), len(points)+4)
-    g.delete_vertices(tempPointsIndices)
+    edges = vor.ridge_points[np.array(keepEdge, dtype=bool)]
 
-    g.vs['isBorder'] = isBorder
-    g.vs['pos'] = points.tolist()
-
-    return g, cellCollection
+    return cellCollection, isBorder, edges
 
 def plot_voronoi(cellCollection, ax):
     """Plot Voronoi network
@@ -134,20 +230,83 @@ def plot_data(points, g, cellCollection, ax):
     gnx = nx.Graph(g.get_edgelist())
     draw.draw_networkx_edges(gnx, points)
 
-def voronoi_from_mask(img_mask):
-    '''Calculate voronoi network from a given mask image.'''
+def voronoi_from_mask(img_mask, glands=None):
+    '''Calculate voronoi network from a given mask image. If `glands` (see glands.extract_glands())
+    is given, its centroids are used instead of labeling the mask again.'''
     
-    lbl, nro = ndimage.label(img_mask)
-    idx = np.array(range(1, nro+1, 1))
-    cm = ndimage.measurements.center_of_mass(img_mask, lbl, idx)
-    
-    #ROTATE CENTER OF MASS
-    cm = np.array(cm)
-    cm = cm[:,::-1]
-    cm[:,1] = img_mask.shape[0]-cm[:,1]
-
-    vor = Voronoi(cm)
-    points = vor.points
+    points = geometric_graph.centers_of_mass(img_mask, glands)
     g, cell_collection = voronoi_network(points)
     
-    return g, points, cell_collection
\ No newline at end of file
+    return g, points, cell_collection
+
+def voronoi_adjacency(points, allowedRegion=None):
+    """Neighbors of each point in the Voronoi network, without building the cells. The network is
+    the same returned by voronoi_network(): two points are neighbors if their cells share a ridge
+    with at least one vertex inside `allowedRegion`. The ridges are the edges of the Delaunay 
+    triangulation and their vertices are the circumcenters of the triangles, so an edge is kept
+    if the circumcenter of one of its triangles is inside the region. Points with four or more 
+    points on the same circle, which have no probability for real centroids, may give additional 
+    edges of length zero in the Voronoi diagram.
+
+    Parameters
+    ----------
+    points : array_like
+      Position of the points. Each row contains the (x,y) position of a point.
+    allowedRegion : array_like
+      Bounds of the Voronoi tessellation. If None, the bounding box of the points is used.
+
+    Returns
+    -------
+    indptr : numpy array
+      CSR index pointer, the neighbors of point i are indices[indptr[i]:indptr[i+1]]
+    indices : numpy array
+      Neighbors of each point, sorted by index
+    """
+
+    points = np.asarray(points, dtype=float)
+    N = len(points)
+    temporaryPoints, allowedRegion = _padded_points(points, allowedRegion)
+
+    tri = Delaunay(temporaryPoints)
+    simplices = tri.simplices
+    circumcenters = _circumcenters(temporaryPoints[simplices])
+
+    rectangle = _region_rectangle(allowedRegion)
+    if rectangle is None:
+        regionPol = Polygon.Polygon(allowedRegion)
+        inside = np.array([regionPol.isInside(x, y)==True for x, y in circumcenters.tolist()], dtype=bool)
+    else:
+        xmin, ymin, xmax, ymax = rectangle
+        inside = ((circumcenters[:,0]>=xmin) & (circumcenters[:,0]<=xmax) & 
+                  (circumcenters[:,1]>=ymin) & (circumcenters[:,1]<=ymax))
+
+    simplices = simplices[inside]
+    edges = np.concatenate((simplices[:,[0,1]], simplices[:,[1,2]], simplices[:,[2,0]]))
+    edges = edges[np.all(edges<N, axis=1)]
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    indptr, indices, _ = edges_to_csr(edges, None, N)
+
+    return indptr, indices
+
+def voronoi_adjacency_from_mask(img_mask, glands=None):
+    '''Calculate the neighbors of the glands in the voronoi network of a mask image (see 
+    voronoi_adjacency()). Returns the CSR arrays indptr and indices and the positions of the glands.'''
+
+    points = geometric_graph.centers_of_mass(img_mask, glands)
+    indptr, indices = voronoi_adjacency(points)
+
+    return indptr, indices, points
+
+def _circumcenters(triangles):
+    """Circumcenters of an [T,3,2] array of triangles."""
+
+    a = triangles[:,0]
+    b = triangles[:,1] - a
+    c = triangles[:,2] - a
+    d = 2*(b[:,0]*c[:,1] - b[:,1]*c[:,0])
+    b2 = np.sum(b*b, axis=1)
+    c2 = np.sum(c*c, axis=1)
+    ux = (c[:,1]*b2 - b[:,1]*c2)/d
+    uy = (b[:,0]*c2 - c[:,0]*b2)/d
+
+    return a + np.column_stack((ux, uy))